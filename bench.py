@@ -0,0 +1,563 @@
+#!/usr/bin/env python
+#
+# uProject benchmark
+#
+# Generates synthetic projects of various shapes and times each stage
+# of drawing them: YAML load, schema validation, reference resolution,
+# normalize_grid, drawing and PDF output, plus the peak memory of the
+# process, and checks the startup time of the script against a target.
+# Results can be written as JSON and compared with an earlier run, so
+# regressions show up across versions.
+#
+# Usage:
+#     bench.py                      run the standard cases
+#     bench.py -o new.json          ...and save the results
+#     bench.py --compare old.json   ...and compare with earlier results
+#     bench.py --rows 5000 --depth 50 --save-yaml /tmp
+#     bench.py --check              check normalize_grid and stop
+#
+# Copyright (c) 2015-2017 Mark J White <mark@celos.net>
+# Distributed under 2-clause BSD licence; no warranty. See COPYING.txt.
+
+import argparse
+import collections
+import json
+import multiprocessing
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import os
+from datetime import date, timedelta
+
+import yaml
+import uproject
+
+# synthetic projects
+
+CASES = collections.OrderedDict([
+    ('small',   dict(rows=20)),
+    ('medium',  dict(rows=300)),
+    ('large',   dict(rows=2000)),
+    ('deep',    dict(rows=1000, depth=1000)),
+    ('fan-in',  dict(rows=1000, fanin=6)),
+    ('busy',    dict(rows=500, breaks=20, phases=10)),
+    ('monthly', dict(rows=300, unit='month', length=36)),
+])
+
+def generate(rows=100,depth=5,fanin=1,breaks=2,phases=1,
+        unit='week',length=52,seed=1):
+    """
+    Return YAML text for a synthetic project with the given number of
+    rows. Activities start relative to the one before in chains of
+    depth rows, and each has up to fanin dependencies on recent
+    activities. breaks and phases are the number of rows of each kind
+    per 100 rows, with three periods each.
+    """
+    rand = random.Random(seed)
+    if unit == 'week':
+        start = uproject.monday(date(2016,1,4))
+    else:
+        start = date(2016,1,1)
+
+    out = ['project: Synthetic',
+           'version: 1.0',
+           'unit: %s' % unit,
+           'length: %d' % length,
+           'start: %s' % start.isoformat(),
+           'options:',
+           '    key_legend: true',
+           '    key_in_block: true',
+           'keys:',
+           '  - name: Dev',
+           '    color: [150,70,70]',
+           '  - name: Ops',
+           '    color: [80,150,80]',
+           '  - name: QA',
+           '    color: [70,70,150]',
+           'rows:']
+
+    def periods(kind):
+        out.append('    %s:' % kind)
+        for k in range(3):
+            out.append('      - name: %s %d' % (kind.capitalize()[:-1], k))
+            out.append('        at: %d' % rand.randint(0, length - 2))
+            out.append('        length: %.1f' % (rand.random() * 2 + 0.5))
+
+    tasks = []
+    special = collections.defaultdict(int)
+    for n in range(rows):
+        # spread breaks, phases and section headings through the rows
+        for kind, per100 in (('breaks', breaks), ('phases', phases)):
+            special[kind] += per100
+            if special[kind] >= 100:
+                special[kind] -= 100
+                out.append('  - name: %s %d' % (kind.capitalize(), n))
+                periods(kind)
+        if n % 40 == 39:
+            out.append('  - name: Section %d' % n)
+            out.append('    gap: true')
+
+        name = 'T%d' % n
+        out.append('  - name: %s task' % name)
+        if tasks and len(tasks) % depth != 0:
+            prev = tasks[-1]
+            choice = rand.random()
+            if choice < 0.4:
+                out.append('    at: -%s' % prev)
+            elif choice < 0.7:
+                out.append('    at: [-%s, %.1f]' % (prev, rand.random()))
+            else:
+                out.append('    at: %s' % prev)
+        elif rand.random() < 0.5:
+            out.append('    at: %d' % rand.randint(0, length * 3 // 4))
+        else:
+            if unit == 'week':
+                d = start + timedelta(7 * rand.randint(0, length * 3 // 4))
+            else:
+                d = start + timedelta(30 * rand.randint(0, length * 3 // 4))
+            out.append('    at: %s' % d.isoformat())
+
+        if rand.random() < 0.85:
+            out.append('    length: %.1f' % (rand.random() * 3 + 0.5))
+            if rand.random() < 0.5:
+                out.append('    key: %s' % rand.choice(['dev','ops','qa']))
+
+        recent = tasks[-20:]
+        if recent and fanin > 0:
+            deps = rand.sample(recent, min(len(recent),
+                rand.randint(1, fanin)))
+            out.append('    dep: [%s]' % ', '.join(deps))
+        tasks.append(name)
+
+    return '\n'.join(out) + '\n'
+
+# timing the stages of drawing one project
+
+class Stopwatch(object):
+    """
+    Accumulate wall time per named stage, including time spent in
+    wrapped functions.
+    """
+    def __init__(self):
+        self.times = collections.defaultdict(float)
+
+    def wrap(self,name,fn):
+        def timed(*args,**kwargs):
+            start = time.time()
+            try:
+                return fn(*args,**kwargs)
+            finally:
+                self.times[name] += time.time() - start
+        return timed
+
+    def time(self,name,fn,*args):
+        return self.wrap(name,fn)(*args)
+
+def peak_rss():
+    """
+    Peak resident set size of this process in kB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+def run_case(args):
+    """
+    Time each stage of drawing one case, taking the best of repeat
+    runs. Runs in a fresh worker process, so peak memory is the
+    case's own. The total counts validate (pykwalify), not
+    validate_fast.
+    """
+    name, params, repeat = args
+    text = generate(**params)
+    base_rss = peak_rss()
+
+    watch = Stopwatch()
+    uproject.normalize_grid = watch.wrap('normalize_grid',
+            uproject.normalize_grid)
+    uproject.Document.output = watch.wrap('output', uproject.Document.output)
+
+    # synthetic dependencies often start before their activity; keep
+    # render()'s warnings about them out of the results
+    sys.stdout = open(os.devnull, 'w')
+
+    best = {}
+    for i in range(repeat):
+        watch.times.clear()
+        project = watch.time('load', uproject.parse, text)
+        if uproject.have_pykwalify():
+            watch.time('validate', uproject.validate, project)
+        watch.time('validate_fast', uproject.validate, project, True)
+        resolver = uproject.Resolver(project)
+        watch.time('resolve', resolver.resolve)
+        start = time.time()
+        pdf = uproject.render(project, resolver=resolver)
+        total = time.time() - start
+        watch.times['draw'] = (total - watch.times['normalize_grid'] -
+                watch.times['output'])
+        for stage, elapsed in watch.times.items():
+            best[stage] = min(best.get(stage, elapsed), elapsed)
+
+    return {
+        'name': name,
+        'params': params,
+        'input_bytes': len(text),
+        'pdf_bytes': len(pdf),
+        'times': best,
+        'total': sum([elapsed for stage, elapsed in best.items()
+            if stage != 'validate_fast']),
+        'base_rss_kb': base_rss,
+        'peak_rss_kb': peak_rss(),
+    }
+
+def bench(cases,repeat=3):
+    """
+    Run each (name, params) case in its own worker process, returning
+    a list of results.
+    """
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        return pool.map(run_case,
+                [(name, params, repeat) for name, params in cases], 1)
+    finally:
+        pool.close()
+        pool.join()
+
+# startup time of a fresh interpreter
+
+# seconds uproject.py may add to bare interpreter startup when
+# redrawing a small project from its cache (the common CI case)
+STARTUP_TARGET = 0.15
+
+def startup(repeat=5):
+    """
+    Best wall time of fresh interpreters doing nothing ('python'),
+    importing uproject ('import'), failing on a usage error ('usage'),
+    redrawing a small project from the cache ('cached') and drawing it
+    with the fast validator ('fast_validate').
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+            'uproject.py')
+    tmp = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(tmp, 'small.yml'), 'w') as fh:
+            fh.write(generate(**CASES['small']))
+        commands = [
+            ('python', ['-c', 'pass']),
+            ('import', ['-c', 'import sys; sys.path.insert(0, %r); '
+                'import uproject' % os.path.dirname(script)]),
+            ('usage', [script]),
+            ('cached', [script, '--cache', 'cache', 'small.yml']),
+            ('fast_validate', [script, '--fast-validate', 'small.yml']),
+        ]
+        times = collections.OrderedDict()
+        with open(os.devnull, 'w') as null:
+            subprocess.call([sys.executable] + commands[3][1], cwd=tmp,
+                    stdout=null, stderr=null)
+            for name, args in commands:
+                best = None
+                for i in range(repeat):
+                    start = time.time()
+                    subprocess.call([sys.executable] + args, cwd=tmp,
+                            stdout=null, stderr=null)
+                    elapsed = time.time() - start
+                    best = min(best, elapsed) if best is not None else elapsed
+                times[name] = best
+        return times
+    finally:
+        shutil.rmtree(tmp)
+
+# reporting
+
+STAGES = ('load', 'validate', 'validate_fast', 'resolve', 'normalize_grid',
+        'draw', 'output')
+
+def environment():
+    """
+    Describe the code and interpreter being measured.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        with open(os.devnull, 'w') as null:
+            commit = subprocess.check_output(['git', 'describe',
+                '--always', '--dirty'], cwd=here, stderr=null).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'libyaml': hasattr(yaml, 'CSafeLoader'),
+        'pykwalify': uproject.have_pykwalify(),
+    }
+
+def print_table(results):
+    print '%-10s' % 'case' + ''.join(['%15s' % s for s in STAGES]) + \
+            '%10s%10s' % ('total', 'peak MB')
+    for r in results:
+        times = r['times']
+        print '%-10s' % r['name'] + ''.join(
+                ['%15s' % ('%.4f' % times[s] if s in times else '-')
+                    for s in STAGES]) + \
+                '%10.3f%10.1f' % (r['total'], r['peak_rss_kb'] / 1024.0)
+
+def print_startup(times,target):
+    print 'startup    ' + ''.join(['%15s' % name for name in times])
+    print '%-10s ' % '' + ''.join(['%15.4f' % t for t in times.values()])
+    overhead = times['cached'] - times['python']
+    print 'cached redraw adds %.3fs to interpreter startup (target %.3fs)' % (
+            overhead, target)
+    return overhead <= target
+
+def compare(old,new,threshold):
+    """
+    Print the ratio of new to old time for each stage of each case
+    present in both, returning the number slower than threshold.
+    """
+    before = dict([(r['name'], r) for r in old['results']])
+    slower = 0
+    print 'compared with %s (%s)' % (old['env']['commit'], old['env']['date'])
+    for r in new['results']:
+        if r['name'] not in before:
+            continue
+        prev = before[r['name']]
+        cells = []
+        for stage in STAGES + ('total',):
+            if stage == 'total':
+                a, b = prev['total'], r['total']
+            elif stage in prev['times'] and stage in r['times']:
+                a, b = prev['times'][stage], r['times'][stage]
+            else:
+                cells.append('%15s' % '-')
+                continue
+            ratio = b / max(a, 1e-6)
+            flag = ' '
+            if ratio > threshold and b - a > 0.005:
+                slower += 1
+                flag = '!'
+            cells.append('%14.2fx%s' % (ratio, flag))
+        print '%-10s' % r['name'] + ''.join(cells)
+    return slower
+
+# correctness checks
+
+def pairwise_normalize_grid(lst):
+    """
+    The pairwise merge normalize_grid() used before it swept sorted
+    segments, kept to check the new one against.
+    """
+    def inline(axis,*lst):
+        return len(set([getattr(e,axis) for e in lst])) == 1
+
+    def maybe_merge(axis,pair1,pair2):
+        s1 = getattr(pair1[0], axis)
+        s2 = getattr(pair2[0], axis)
+        e1 = getattr(pair1[1], axis)
+        e2 = getattr(pair2[1], axis)
+        if s1 <= s2 and s2 <= e1:
+            return (pair1[0], pair2[1])
+        if s1 <= e2 and e2 <= e1:
+            return (pair2[0], pair1[1])
+        return None
+
+    def maybe_merge_both(pair1,pair2):
+        if inline('x',pair1[0],pair1[1],pair2[0],pair2[1]):
+            return maybe_merge('y',pair1,pair2)
+        elif inline('y',pair1[0],pair1[1],pair2[0],pair2[1]):
+            return maybe_merge('x',pair1,pair2)
+        else:
+            return None
+
+    new_lst = []
+    status = [True for e in lst]
+    for i,e in enumerate(lst):
+        if not status[i]:
+            continue
+        status[i] = False
+        did_merge = False
+        for j,f in enumerate(lst):
+            if not status[j]:
+                continue
+            r = maybe_merge_both(e,f)
+            if r:
+                status[j] = False
+                new_lst.append(r)
+                did_merge = True
+                break
+
+        if not did_merge:
+            new_lst.append(e)
+
+    if len(lst) == len(new_lst):
+        return new_lst
+    else:
+        return pairwise_normalize_grid(new_lst)
+
+def random_segments(rand,nested):
+    """
+    Random horizontal and vertical segments on a few grid lines, each
+    running top-to-bottom or left-to-right as Calendar.draw_dep()
+    makes them. Unless nested is set, a segment only overlaps or
+    touches the ones before and after it on its line, so none lies
+    inside another, or inside two others merged.
+    """
+    Point = uproject.Point
+    segments = []
+    lines = set([(rand.choice('xy'), rand.randint(0, 20))
+        for i in range(rand.randint(1, 4))])
+    for axis, pos in sorted(lines):
+        start = rand.randint(0, 10)
+        last_end = -1
+        for i in range(rand.randint(1, 8)):
+            if nested:
+                start = rand.randint(0, 40)
+                end = start + rand.randint(1, 15)
+            else:
+                end = max(start + rand.randint(1, 6), last_end + 1)
+            if axis == 'x':
+                segments.append((Point(pos, start), Point(pos, end)))
+            else:
+                segments.append((Point(start, pos), Point(end, pos)))
+            if not nested:
+                start, last_end = rand.randint(max(start, last_end) + 1,
+                        end + 2), end
+    rand.shuffle(segments)
+    return segments
+
+def union(segments):
+    """
+    The union of integer segments on each grid line, found by marking
+    every unit they cover, as a sorted list.
+    """
+    Point = uproject.Point
+    covered = {}
+    for p1, p2 in segments:
+        if p1.x == p2.x:
+            line, s, e = ('x', p1.x), p1.y, p2.y
+        else:
+            line, s, e = ('y', p1.y), p1.x, p2.x
+        covered.setdefault(line, set()).update(range(s, e))
+    result = []
+    for (axis, pos), units in covered.items():
+        units = sorted(units)
+        start = units[0]
+        for prev, unit in zip(units, units[1:] + [None]):
+            if unit != prev + 1:
+                if axis == 'x':
+                    result.append((Point(pos, start), Point(pos, prev + 1)))
+                else:
+                    result.append((Point(start, pos), Point(prev + 1, pos)))
+                start = unit
+    return sorted(result)
+
+def check_normalize_grid(trials=2000,seed=1):
+    """
+    Check normalize_grid() against the pairwise merge on segments
+    which don't nest, and against the true union on segments which
+    do (where the pairwise merge could cut a segment short). Returns
+    the number of failures, printing the first few.
+    """
+    rand = random.Random(seed)
+    failures = 0
+    for trial in range(trials):
+        nested = trial % 2 == 1
+        segments = random_segments(rand, nested)
+        got = sorted(uproject.normalize_grid(segments))
+        if nested:
+            want = union(segments)
+        else:
+            want = sorted(pairwise_normalize_grid(segments))
+        if got != want:
+            failures += 1
+            if failures <= 3:
+                print 'normalize_grid(%r)\n  gave %r\n  want %r' % (
+                        segments, got, want)
+    print 'normalize_grid: %d of %d checks failed' % (failures, trials)
+    return failures
+
+# toplevel
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='bench.py',
+            description='Time the stages of drawing synthetic projects.')
+    parser.add_argument('case', nargs='*',
+            help='standard cases to run (default: all of %s)' %
+                ', '.join(CASES))
+    parser.add_argument('--rows', type=int,
+            help='run one custom case with this many rows')
+    parser.add_argument('--depth', type=int, default=5,
+            help='reference chain depth for a custom case')
+    parser.add_argument('--fanin', type=int, default=1,
+            help='maximum dependencies per row for a custom case')
+    parser.add_argument('--breaks', type=int, default=2,
+            help='break rows per 100 rows for a custom case')
+    parser.add_argument('--phases', type=int, default=1,
+            help='phase rows per 100 rows for a custom case')
+    parser.add_argument('--unit', choices=['week', 'month'], default='week')
+    parser.add_argument('--length', type=int, default=52,
+            help='timeline length in units for a custom case')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+            help='runs per case; the best time of each stage is kept')
+    parser.add_argument('-o', '--output', metavar='JSON',
+            help='write results to this file')
+    parser.add_argument('--compare', metavar='JSON',
+            help='compare with results from an earlier run')
+    parser.add_argument('--threshold', type=float, default=1.25,
+            help='ratio above which --compare reports a regression')
+    parser.add_argument('--save-yaml', metavar='DIR',
+            help='also write the generated projects to DIR')
+    parser.add_argument('--check', action='store_true',
+            help='check normalize_grid against the old merge and stop')
+    parser.add_argument('--startup-target', type=float,
+            default=STARTUP_TARGET, metavar='SECONDS',
+            help='most a cached redraw may add to interpreter startup')
+    args = parser.parse_args(argv)
+
+    if args.check:
+        if check_normalize_grid():
+            sys.exit(1)
+        return
+
+    if args.rows is not None:
+        cases = [('custom', dict(rows=args.rows, depth=args.depth,
+            fanin=args.fanin, breaks=args.breaks, phases=args.phases,
+            unit=args.unit, length=args.length))]
+    else:
+        for name in args.case:
+            if name not in CASES:
+                parser.error('unknown case %s' % name)
+        cases = [(name, params) for name, params in CASES.items()
+                if not args.case or name in args.case]
+
+    if args.save_yaml:
+        for name, params in cases:
+            with open(os.path.join(args.save_yaml, name + '.yml'), 'w') as fh:
+                fh.write(generate(**params))
+
+    results = {'env': environment(), 'results': bench(cases, args.repeat),
+            'startup': startup()}
+    print_table(results['results'])
+    ok = print_startup(results['startup'], args.startup_target)
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(results, fh, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as fh:
+            old = json.load(fh)
+        if compare(old, results, args.threshold):
+            ok = False
+
+    if not ok:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -19,46 +19,42 @@
 # Dependencies:
 #     pyFPDF:    "pip install fpdf" (required)
 #     pykwalify: "pip install pykwalify" (optional)
+#     NumPy:     "pip install numpy" (optional)
 # 
 # Copyright (c) 2015-2017 Mark J White <mark@celos.net>
 # Distributed under 2-clause BSD licence; no warranty. See COPYING.txt.
 #
 
-import logging
-logging.basicConfig()
-logging.getLogger('pykwalify.core').setLevel('CRITICAL')
-
-try:
-    import pykwalify.core
-    import pykwalify.errors
-    HAVE_PYKWALIFY = True
-except ImportError:
-    HAVE_PYKWALIFY = False
+# Modules which are slow to import or only needed by some paths
+# (yaml, pykwalify, multiprocessing etc) are imported where they are
+# used, so that a usage error or a cached render doesn't pay for them.
 
 from datetime import date, timedelta
-from pprint import pprint
 import collections
-import yaml
 import sys
 import re
 import os
-import inspect
+import math
+import zlib
+import types
+import glob
+import time
+import bisect
+import hashlib
+import cPickle
+import contextlib
 
 from fpdf import FPDF
 
 Point = collections.namedtuple('Point',['x','y'])
+Page = collections.namedtuple('Page',['first','end','highlight'])
 
 # relative-date utilities
 
 # -- week
 
 def monday(d):
-    wd = int(d.strftime("%w"))
-    if wd == 0:
-        wd = 6
-    else:
-        wd -= 1
-    return d - timedelta(days=wd)
+    return d - timedelta(days=d.weekday())
 
 def prev_week(d):
     return monday(monday(d) - timedelta(days=7))
@@ -84,58 +80,834 @@ def n_months(d1,d2):
     return (d2.year - d1.year)*12 + d2.month - d1.month \
             + (d2.day - d1.day)/30.42
 
-# utilities to merge overlapping line segments on a grid
+# -- unit tables
 
-def inline(axis,*lst):
-    return len(set([getattr(e,axis) for e in lst])) == 1
+_numpy = {}
 
-def maybe_merge(axis,pair1,pair2):
-    s1 = getattr(pair1[0], axis)
-    s2 = getattr(pair2[0], axis)
-    e1 = getattr(pair1[1], axis)
-    e2 = getattr(pair2[1], axis)
-    if s1 <= s2 and s2 <= e1:
-        return (pair1[0], pair2[1])
-    if s1 <= e2 and e2 <= e1:
-        return (pair2[0], pair1[1])
-    return None
+def have_numpy():
+    """
+    True if NumPy is installed. It is imported the first time this is
+    called.
+    """
+    if 'installed' not in _numpy:
+        try:
+            import numpy
+            _numpy['installed'] = True
+        except ImportError:
+            _numpy['installed'] = False
+    return _numpy['installed']
 
-def maybe_merge_both(pair1,pair2):
-    if inline('x',pair1[0],pair1[1],pair2[0],pair2[1]):
-        return maybe_merge('y',pair1,pair2)
-    elif inline('y',pair1[0],pair1[1],pair2[0],pair2[1]):
-        return maybe_merge('x',pair1,pair2)
-    else:
-        return None
+class UnitTable(object):
+    """
+    Positions of dates in units of a calendar: weeks from the Monday,
+    or months from the first of the month, of a start date, as
+    n_weeks() and n_months() give them. Each date is converted once,
+    with day or month arithmetic rather than by stepping through units,
+    and convert() does many at once, with NumPy if there are enough to
+    be worth it. The start date of each unit is kept for the time axis.
+    """
+
+    BULK = 5000
+
+    def __init__(self,unit,start):
+        self.unit = unit
+        if unit == 'month':
+            self.first = first(start)
+        else:
+            self.first = monday(start)
+        self.origin = self.first.toordinal()
+        self.positions = {}
+        self.unit_starts = []
+
+    def position(self,d):
+        """
+        Position of date d in units from the start.
+        """
+        pos = self.positions.get(d)
+        if pos is None:
+            if self.unit == 'month':
+                pos = (d.year - self.first.year)*12 + \
+                        d.month - self.first.month + (d.day - 1)/30.42
+            else:
+                pos = float(d.toordinal() - self.origin) / 7.0
+            self.positions[d] = pos
+        return pos
+
+    def convert(self,dates):
+        """
+        Positions of a list of dates, converting any not seen before in
+        one batch.
+        """
+        new = [d for d in set(dates) if d not in self.positions]
+        count('dates converted', len(new))
+        if len(new) < self.BULK or not have_numpy():
+            for d in new:
+                self.position(d)
+        else:
+            import numpy
+            n = len(new)
+            if self.unit == 'month':
+                years = numpy.fromiter((d.year for d in new), int, n)
+                months = numpy.fromiter((d.month for d in new), int, n)
+                days = numpy.fromiter((d.day for d in new), int, n)
+                pos = (years - self.first.year)*12 + \
+                        months - self.first.month + (days - 1)/30.42
+            else:
+                days = numpy.fromiter((d.toordinal() for d in new), int, n)
+                pos = (days - self.origin) / 7.0
+            self.positions.update(zip(new, pos.tolist()))
+        return [self.positions[d] for d in dates]
+
+    def start(self,i):
+        """
+        Start date of unit i, which may be negative.
+        """
+        if self.unit == 'month':
+            year, month = divmod(self.first.month - 1 + i, 12)
+            return date(self.first.year + year, month + 1, 1)
+        return self.first + timedelta(days=7*i)
+
+    def starts(self,n):
+        """
+        Start dates of the first n units.
+        """
+        for i in range(len(self.unit_starts), n):
+            self.unit_starts.append(self.start(i))
+        return self.unit_starts[:n]
 
+_unit_tables = {}
+
+def unit_table(unit,start):
+    """
+    The UnitTable for a unit and start date, shared by everything
+    drawing or resolving a calendar with that start.
+    """
+    key = (unit, start)
+    table = _unit_tables.get(key)
+    if table is None:
+        if len(_unit_tables) >= 64:
+            _unit_tables.clear()
+        table = _unit_tables[key] = UnitTable(unit,start)
+    return table
+
+def nice_steps():
+    """
+    Generate 1, 2, 5, 10, 20, 50... forever.
+    """
+    step = 1
+    while True:
+        for m in (1, 2, 5):
+            yield step * m
+        step *= 10
+
+# profiling
+
+_profile = None
+
+class Profile(object):
+    """
+    Wall time and call counts for each stage of drawing and each
+    Calendar method, plus counters of work done. Use it as a context
+    manager around draw() or render(). Functions added with add_hook()
+    are called as hook(kind, name, elapsed) after each timed stage
+    ('stage') or call ('call'). Call times include nested calls.
+    """
+    def __init__(self):
+        self.stages = collections.OrderedDict()
+        self.calls = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+        self.hooks = []
+        self.outer = None
+
+    def __enter__(self):
+        global _profile
+        self.outer = _profile
+        _profile = self
+        return self
+
+    def __exit__(self,*exc):
+        global _profile
+        _profile = self.outer
+
+    def add_hook(self,hook):
+        self.hooks.append(hook)
+
+    def record(self,kind,name,elapsed):
+        if kind == 'stage':
+            entry = self.stages.setdefault(name, [0, 0.0])
+        else:
+            entry = self.calls.setdefault(name, [0, 0.0])
+        entry[0] += 1
+        entry[1] += elapsed
+        for hook in self.hooks:
+            hook(kind, name, elapsed)
+
+    def count(self,name,n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def as_dict(self):
+        times = lambda d: collections.OrderedDict([(name,
+            collections.OrderedDict([('calls', calls), ('seconds', seconds)]))
+            for name, (calls, seconds) in d.items()])
+        return collections.OrderedDict([
+            ('stages', times(self.stages)),
+            ('calls', times(self.calls)),
+            ('counters', self.counters)])
+
+    def json(self):
+        import json
+        return json.dumps(self.as_dict(), indent=2)
+
+    def table(self):
+        lines = []
+        for title, entries in (('stage', self.stages), ('call', self.calls)):
+            lines.append('%-32s %8s %10s' % (title, 'calls', 'seconds'))
+            for name, (calls, seconds) in entries.items():
+                lines.append('  %-30s %8d %10.4f' % (name, calls, seconds))
+        lines.append('%-32s %8s' % ('counter', 'count'))
+        for name, value in self.counters.items():
+            lines.append('  %-30s %8d' % (name, value))
+        return '\n'.join(lines)
+
+def count(name,n=1):
+    """
+    Add n to a counter of the active Profile, if any.
+    """
+    if _profile is not None:
+        _profile.count(name, n)
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Time a stage of drawing in the active Profile, if any.
+    """
+    if _profile is None:
+        yield
+        return
+    profile = _profile
+    start = time.time()
+    try:
+        yield
+    finally:
+        profile.record('stage', name, time.time() - start)
+
+def profiled(fn,name=None):
+    """
+    Wrap a function so its calls are timed in the active Profile, if
+    any.
+    """
+    if name is None:
+        name = fn.__name__
+    def wrapper(*args,**kwargs):
+        if _profile is None:
+            return fn(*args,**kwargs)
+        profile = _profile
+        start = time.time()
+        try:
+            return fn(*args,**kwargs)
+        finally:
+            profile.record('call', name, time.time() - start)
+    wrapper.__name__ = fn.__name__
+    wrapper.__doc__ = fn.__doc__
+    return wrapper
+
+def profiled_methods(cls):
+    """
+    Class decorator applying profiled() to every method.
+    """
+    for name, value in cls.__dict__.items():
+        if isinstance(value, types.FunctionType) and \
+                not name.startswith('__'):
+            setattr(cls, name, profiled(value, cls.__name__ + '.' + name))
+    return cls
+
+# utility to merge overlapping line segments on a grid
+
+@profiled
 def normalize_grid(lst):
+    """
+    Merge overlapping or touching segments which lie on the same
+    vertical or horizontal grid line. Segments are grouped by line,
+    sorted, and swept in order, so this is O(n log n) overall.
+    """
+    lines = {}
     new_lst = []
-    status = [True for e in lst]
-    for i,e in enumerate(lst):
-        if not status[i]:
+    for p1, p2 in lst:
+        if p1.x == p2.x:
+            line = ('x', p1.x)
+            span = (min(p1.y,p2.y), max(p1.y,p2.y))
+        elif p1.y == p2.y:
+            line = ('y', p1.y)
+            span = (min(p1.x,p2.x), max(p1.x,p2.x))
+        else:
+            new_lst.append((p1, p2))
             continue
-        status[i] = False
-        did_merge = False
-        for j,f in enumerate(lst):
-            if not status[j]:
-                continue
-            r = maybe_merge_both(e,f)
-            if r:
-                status[j] = False
-                new_lst.append(r)
-                did_merge = True
-                break
+        lines.setdefault(line, []).append(span)
+
+    for (axis, pos), spans in sorted(lines.items()):
+        spans.sort()
+        merged = [list(spans[0])]
+        for s, e in spans[1:]:
+            if s <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], e)
+            else:
+                merged.append([s, e])
+        for s, e in merged:
+            if axis == 'x':
+                new_lst.append((Point(pos, s), Point(pos, e)))
+            else:
+                new_lst.append((Point(s, pos), Point(e, pos)))
+    return new_lst
 
-        if not did_merge:
-            new_lst.append(e)
+# text measurement
 
-    if len(lst) == len(new_lst):
-        return new_lst
-    else:
-        return normalize_grid(new_lst)
+class TextMetrics(object):
+    """
+    Cache of string widths for a PDF object. Width scales linearly
+    with font size, so each (family, style, text) is measured once.
+    """
+
+    _FONT = ('font_family', 'font_style', 'font_size_pt', 'font_size',
+            'current_font', 'unifontsubset', 'font_op')
+
+    def __init__(self,pdf):
+        self.pdf = pdf
+        self.widths = {}
+
+    def width(self,txt,family,style,size):
+        """
+        Width of txt in the given font.
+        """
+        key = (family, style, txt)
+        if key not in self.widths:
+            pdf = self.pdf
+            current = dict([(name, getattr(pdf, name, None))
+                for name in self._FONT])
+            pdf.set_font(family, style, 10.0)
+            self.widths[key] = pdf.get_string_width(txt) / 10.0
+            if hasattr(pdf, 'font_op'):
+                # a Document only selects fonts when drawing text, so
+                # nothing is on the page yet and the state can be put back
+                for name, value in current.items():
+                    setattr(pdf, name, value)
+            elif current['font_family']:
+                pdf.set_font(current['font_family'], current['font_style'],
+                        current['font_size_pt'])
+        return self.widths[key] * size
+
+    def fit(self,txt,family,style,size,width):
+        """
+        Largest font size, stepping down from size by 0.1pt, at which
+        txt is no wider than width.
+        """
+        unit = self.width(txt,family,style,1.0)
+        if unit == 0.0 or unit * size <= width:
+            return size
+        steps = math.ceil((size - width / unit) / 0.1 - 1e-9)
+        return size - steps * 0.1
+
+# PDF document with state tracking and reusable templates
+
+class OutputBuffer(object):
+    """
+    Stand-in for the string FPDF builds its output in, which it adds
+    to with += and measures with len(). The pieces are kept in a list
+    and joined once, rather than the whole string being copied for
+    every line, or written straight through to a stream if one is
+    given.
+    """
+
+    def __init__(self,stream=None):
+        self.stream = stream
+        self.chunks = []
+        self.length = 0
+
+    def __iadd__(self,s):
+        self.length += len(s)
+        if self.stream is None:
+            self.chunks.append(s)
+        else:
+            self.stream.write(s)
+        return self
+
+    def __len__(self):
+        return self.length
+
+    def getvalue(self):
+        return ''.join(self.chunks)
+
+class Document(FPDF):
+    """
+    FPDF document which skips colour and line width changes that
+    don't change anything, only selects a font when text is actually
+    drawn in it, and batches consecutive filled rectangles and lines
+    into one path per colour. It can also capture drawing
+    into a template (a PDF form XObject) and stamp it onto any number
+    of pages, so repeated content is only stored once.
+
+    If a stream is given, each page is written to it, compressed, as
+    soon as the next one is started, and then forgotten, so only the
+    current page is kept in memory; close() writes the rest. The
+    output is the same as output() would give.
+    """
+
+    _STATE = ('font_family', 'font_style', 'font_size_pt', 'font_size',
+            'current_font', 'unifontsubset', 'underline', 'draw_color',
+            'fill_color', 'text_color', 'color_flag', 'line_width')
+
+    def __init__(self,*args,**kwargs):
+        stream = kwargs.pop('stream', None)
+        FPDF.__init__(self,*args,**kwargs)
+        self.stream = stream
+        self.buffer = OutputBuffer(stream)
+        self.pages_written = 0
+        self.header_written = False
+        self.templates = []
+        self.template_objects = []
+        self.path = []
+        self.path_op = None
+        self.font_op = None
+
+    def set_draw_color(self,r,g=-1,b=-1):
+        if (r==0 and g==0 and b==0) or g==-1:
+            color = '%.3f G' % (r/255.0)
+        else:
+            color = '%.3f %.3f %.3f RG' % (r/255.0, g/255.0, b/255.0)
+        if color != self.draw_color:
+            FPDF.set_draw_color(self,r,g,b)
+
+    def set_fill_color(self,r,g=-1,b=-1):
+        if (r==0 and g==0 and b==0) or g==-1:
+            color = '%.3f g' % (r/255.0)
+        else:
+            color = '%.3f %.3f %.3f rg' % (r/255.0, g/255.0, b/255.0)
+        if color != self.fill_color:
+            FPDF.set_fill_color(self,r,g,b)
+
+    def set_line_width(self,width):
+        if width != self.line_width:
+            FPDF.set_line_width(self,width)
+
+    def rect(self,x,y,w,h,style=''):
+        if style == 'F' and self.page > 0:
+            self._add_path('f', '%.2f %.2f %.2f %.2f re' %
+                    (x*self.k, (self.h-y)*self.k, w*self.k, -h*self.k))
+        else:
+            FPDF.rect(self,x,y,w,h,style)
+
+    def line(self,x1,y1,x2,y2):
+        if self.page > 0:
+            self._add_path('S', '%.2f %.2f m %.2f %.2f l' %
+                    (x1*self.k, (self.h-y1)*self.k,
+                        x2*self.k, (self.h-y2)*self.k))
+        else:
+            FPDF.line(self,x1,y1,x2,y2)
+
+    def dashed_lines(self,lines,dash_length=1,space_length=1):
+        """
+        Draw lines, pairs of end points, dashed as dashed_line() does,
+        but as one path with the dash pattern set once. The pattern
+        starts afresh on each line, so they look the same.
+        """
+        if not lines:
+            return
+        self._set_dash(dash_length, space_length)
+        for (x1, y1), (x2, y2) in lines:
+            self._add_path('S', '%.2f %.2f m %.2f %.2f l' %
+                    (x1*self.k, (self.h-y1)*self.k,
+                        x2*self.k, (self.h-y2)*self.k))
+        self._set_dash()
+
+    def _add_path(self,op,s):
+        """
+        Add a subpath to the pending path, which is painted with op
+        as soon as anything else is drawn or the state changes.
+        """
+        if op != self.path_op:
+            self._flush_path()
+            self.path_op = op
+        self.path.append(s)
+
+    def _flush_path(self):
+        if self.path:
+            path = self.path
+            self.path = []
+            FPDF._out(self, '%s %s' % (' '.join(path), self.path_op))
+        self.path_op = None
+
+    def _out(self,s):
+        if self.page > 0 and self.state == 2:
+            if s.startswith('BT /F') and s.endswith(' Tf ET'):
+                self.font_op = s
+                return
+        if self.path:
+            self._flush_path()
+        if self.font_op is not None and ') Tj' in s:
+            FPDF._out(self,self.font_op)
+            self.font_op = None
+        FPDF._out(self,s)
+
+    def _endpage(self):
+        self._flush_path()
+        self.font_op = None
+        FPDF._endpage(self)
+        if self.stream is not None:
+            self._put_finished_pages()
+
+    def _put_finished_pages(self):
+        """
+        Write the pages finished since the last call, each as FPDF's
+        _putpages() would (there are no links), and drop their content.
+        """
+        self._putheader()
+        if self.compress:
+            filter = '/Filter /FlateDecode '
+        else:
+            filter = ''
+        w_pt, h_pt = self._page_size()
+        for n in range(self.pages_written + 1, self.page + 1):
+            self._newobj()
+            self._out('<</Type /Page')
+            self._out('/Parent 1 0 R')
+            if n in self.orientation_changes:
+                self._out('/MediaBox [0 0 %.2f %.2f]' % (h_pt, w_pt))
+            self._out('/Resources 2 0 R')
+            if self.pdf_version > '1.3':
+                self._out('/Group <</Type /Group /S /Transparency '
+                        '/CS /DeviceRGB>>')
+            self._out('/Contents %d 0 R>>' % (self.n + 1))
+            self._out('endobj')
+            content = self.pages.pop(n)
+            if self.compress:
+                content = zlib.compress(content)
+            self._newobj()
+            self._out('<<%s/Length %d>>' % (filter, len(content)))
+            self._putstream(content)
+            self._out('endobj')
+            count('pages flushed')
+        self.pages_written = self.page
+
+    def _page_size(self):
+        """
+        Width and height of the default page orientation, in points.
+        """
+        if self.def_orientation == 'P':
+            return self.fw_pt, self.fh_pt
+        return self.fh_pt, self.fw_pt
+
+    def _putheader(self):
+        if not self.header_written:
+            FPDF._putheader(self)
+            self.header_written = True
+
+    def _putpages(self):
+        if self.stream is None:
+            FPDF._putpages(self)
+            return
+        self._put_finished_pages()
+        w_pt, h_pt = self._page_size()
+        self.offsets[1] = len(self.buffer)
+        self._out('1 0 obj')
+        self._out('<</Type /Pages')
+        self._out('/Kids [%s]' % ''.join(['%d 0 R ' % (3 + 2*i)
+            for i in range(self.page)]))
+        self._out('/Count %d' % (self.page,))
+        self._out('/MediaBox [0 0 %.2f %.2f]' % (w_pt, h_pt))
+        self._out('>>')
+        self._out('endobj')
+
+    def _enddoc(self):
+        FPDF._enddoc(self)
+        if self.stream is None:
+            # output() expects a string
+            self.buffer = self.buffer.getvalue()
+
+    def add_page(self,orientation=''):
+        """
+        Start a new page in the default drawing state, rather than
+        carrying over the colours, line width and font of the last one,
+        so a page's content depends only on what is drawn on it.
+        """
+        if self.page > 0:
+            self.font_family = ''
+            self.underline = 0
+            self.line_width = .567/self.k
+            self.draw_color = '0 G'
+            self.fill_color = self.text_color = '0 g'
+            self.color_flag = False
+        FPDF.add_page(self,orientation)
+
+    def preload_fonts(self,family,styles):
+        """
+        Add fonts to the document in the given order, without selecting
+        them, so that documents drawn separately number them the same.
+        """
+        state = dict([(name, getattr(self, name, None))
+            for name in self._STATE + ('font_op',)])
+        for style in styles:
+            FPDF.set_font(self,family,style)
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def begin_template(self):
+        """
+        Start capturing drawing on the current page into a template.
+        Colours, line width and font are forgotten, so the template
+        sets everything it uses itself.
+        """
+        self._flush_path()
+        self._template_start = len(self.pages[self.page])
+        self._template_state = dict([(name, getattr(self, name, None))
+            for name in self._STATE + ('font_op',)])
+        self.font_op = None
+        self.font_family = ''
+        self.draw_color = self.fill_color = self.line_width = None
+        self.color_flag = True
+
+    def end_template(self):
+        """
+        Finish the template started by begin_template(), returning its
+        number for use_template(). The captured drawing is taken off the
+        page, and the drawing state restored to what it was before.
+        """
+        self._flush_path()
+        page = self.pages[self.page]
+        self.templates.append(page[self._template_start:])
+        self.pages[self.page] = page[:self._template_start]
+        for name, value in self._template_state.items():
+            setattr(self, name, value)
+        return len(self.templates) - 1
+
+    def use_template(self,template,dx=0.0,dy=0.0):
+        """
+        Draw a template on the current page, offset by (dx, dy).
+        """
+        self._out('q 1 0 0 1 %.2f %.2f cm /TPL%d Do Q' %
+                (dx*self.k, -dy*self.k, template))
+
+    def _putimages(self):
+        FPDF._putimages(self)
+        self.template_objects = []
+        for content in self.templates:
+            if self.compress:
+                content = zlib.compress(content)
+                filter = '/Filter /FlateDecode '
+            else:
+                filter = ''
+            self._newobj()
+            self._out('<</Type /XObject /Subtype /Form '
+                    '/BBox [0 0 %.2f %.2f] /Resources 2 0 R %s/Length %d>>' %
+                    (self.w_pt, self.h_pt, filter, len(content)))
+            self._putstream(content)
+            self._out('endobj')
+            self.template_objects.append(self.n)
+
+    def _putxobjectdict(self):
+        FPDF._putxobjectdict(self)
+        for i, n in enumerate(self.template_objects):
+            self._out('/TPL%d %d 0 R' % (i, n))
+
+# SVG document with the drawing methods Calendar uses
+
+def _xml(txt):
+    """
+    Text as UTF-8 with XML special characters escaped. Byte strings
+    are taken to be Latin-1, as FPDF does.
+    """
+    if not isinstance(txt, unicode):
+        txt = txt.decode('latin-1')
+    return txt.replace('&', '&amp;').replace('<', '&lt;').replace(
+            '>', '&gt;').encode('utf-8')
+
+class SVGDocument(object):
+    """
+    One-page SVG drawing with the subset of the FPDF interface that
+    Calendar draws with, in the same units (mm) and with the same
+    text positions and widths (from the core font metrics). Each
+    element is written to stream as soon as it is drawn, so only the
+    current position, colours and font are kept. There are no page
+    breaks, so the page must be tall enough for everything drawn on
+    it; call close() to finish the document.
+    """
+
+    def __init__(self,stream,w=297.0,h=210.0):
+        self.stream = stream
+        self.w = w
+        self.h = h
+        self.k = 72.0/25.4
+        self.l_margin = self.t_margin = self.r_margin = 10.0
+        self.c_margin = 1.0
+        self.x = self.l_margin
+        self.y = self.t_margin
+        self.page = 0
+        self.draw_color = self.fill_color = self.text_color = '#000'
+        self.line_width = .567/self.k
+        self.font_family = ''
+        self.font_style = ''
+        self.font_size_pt = 12.0
+        self.font_size = self.font_size_pt/self.k
+        self.current_font = None
+        self.bytes = 0
+
+    def _write(self,s):
+        self.stream.write(s)
+        self.bytes += len(s)
+
+    def add_page(self,orientation=''):
+        if self.page > 0:
+            raise ValueError('an SVG document has only one page')
+        self.page = 1
+        self.x = self.l_margin
+        self.y = self.t_margin
+        self._write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<svg xmlns="http://www.w3.org/2000/svg" '
+                'width="%.2fmm" height="%.2fmm" viewBox="0 0 %.2f %.2f" '
+                'font-family="Helvetica, Arial, sans-serif">\n' %
+                (self.w, self.h, self.w, self.h))
+
+    def close(self):
+        self._write('</svg>\n')
+
+    def set_auto_page_break(self,auto,margin=0):
+        pass
+
+    # position
+
+    def get_x(self):
+        return self.x
+
+    def get_y(self):
+        return self.y
+
+    def set_x(self,x):
+        self.x = x if x >= 0 else self.w + x
+
+    def set_y(self,y):
+        self.x = self.l_margin
+        self.y = y if y >= 0 else self.h + y
+
+    def set_xy(self,x,y):
+        self.set_y(y)
+        self.set_x(x)
+
+    # drawing state
+
+    def _color(self,r,g,b):
+        if g == -1:
+            g = b = r
+        return '#%02x%02x%02x' % (int(r), int(g), int(b))
+
+    def set_draw_color(self,r,g=-1,b=-1):
+        self.draw_color = self._color(r,g,b)
+
+    def set_fill_color(self,r,g=-1,b=-1):
+        self.fill_color = self._color(r,g,b)
+
+    def set_text_color(self,r,g=-1,b=-1):
+        self.text_color = self._color(r,g,b)
+
+    def set_line_width(self,width):
+        self.line_width = width
+
+    def set_font(self,family,style='',size=0):
+        from fpdf.fonts import fpdf_charwidths
+        family = family.lower()
+        if family == 'arial':
+            family = 'helvetica'
+        style = ''.join(sorted(style.upper().replace('U', '')))
+        if size == 0:
+            size = self.font_size_pt
+        self.font_family = family
+        self.font_style = style
+        self.font_size_pt = size
+        self.font_size = size/self.k
+        self.current_font = fpdf_charwidths[family + style]
+
+    def get_string_width(self,s):
+        if isinstance(s, unicode):
+            s = s.encode('latin-1', 'replace')
+        cw = self.current_font
+        return sum([cw.get(c, 0) for c in s])*self.font_size/1000.0
+
+    # shapes
+
+    def _paint(self,style):
+        if style == 'F':
+            return 'fill="%s"' % self.fill_color
+        stroke = 'stroke="%s" stroke-width="%.2f"' % (self.draw_color,
+                self.line_width)
+        if style in ('FD', 'DF'):
+            return 'fill="%s" %s' % (self.fill_color, stroke)
+        return 'fill="none" %s' % stroke
+
+    def rect(self,x,y,w,h,style=''):
+        self._write('<rect x="%.2f" y="%.2f" width="%.2f" height="%.2f" '
+                '%s/>\n' % (x, y, w, h, self._paint(style)))
+
+    def ellipse(self,x,y,w,h,style=''):
+        self._write('<ellipse cx="%.2f" cy="%.2f" rx="%.2f" ry="%.2f" '
+                '%s/>\n' % (x + w/2.0, y + h/2.0, w/2.0, h/2.0,
+                    self._paint(style)))
+
+    def line(self,x1,y1,x2,y2):
+        self._write('<line x1="%.2f" y1="%.2f" x2="%.2f" y2="%.2f" %s/>\n' %
+                (x1, y1, x2, y2, self._paint('D')))
+
+    def dashed_line(self,x1,y1,x2,y2,dash_length=1,space_length=1):
+        self._write('<line x1="%.2f" y1="%.2f" x2="%.2f" y2="%.2f" %s '
+                'stroke-dasharray="%.3f %.3f"/>\n' %
+                (x1, y1, x2, y2, self._paint('D'),
+                    dash_length, space_length))
+
+    def dashed_lines(self,lines,dash_length=1,space_length=1):
+        if not lines:
+            return
+        self._write('<path d="%s" %s stroke-dasharray="%.3f %.3f"/>\n' %
+                (' '.join(['M%.2f %.2fL%.2f %.2f' % (x1, y1, x2, y2)
+                    for (x1, y1), (x2, y2) in lines]),
+                    self._paint('D'), dash_length, space_length))
+
+    # text
+
+    def _text(self,h,txt):
+        """
+        Draw txt at the current position, vertically centred in a line
+        of height h, as FPDF places it.
+        """
+        attrs = ''
+        if 'B' in self.font_style:
+            attrs += ' font-weight="bold"'
+        if 'I' in self.font_style:
+            attrs += ' font-style="italic"'
+        self._write('<text x="%.2f" y="%.2f" font-size="%.2f" fill="%s"%s>'
+                '%s</text>\n' % (self.x + self.c_margin,
+                    self.y + .5*h + .3*self.font_size, self.font_size,
+                    self.text_color, attrs, _xml(txt)))
+
+    def cell(self,w,h=0,txt='',border=0,ln=0,align='',fill=0,link=''):
+        if w == 0:
+            w = self.w - self.r_margin - self.x
+        if txt != '':
+            self._text(h,txt)
+        if ln > 0:
+            self.y += h
+            if ln == 1:
+                self.x = self.l_margin
+        else:
+            self.x += w
+
+    def write(self,h,txt='',link=''):
+        """
+        Draw txt at the current position and move past it. Unlike FPDF,
+        long text isn't wrapped at the right margin.
+        """
+        if txt != '':
+            self._text(h,txt)
+            self.x += self.get_string_width(txt)
 
 # Gantt-drawing class
 
+@profiled_methods
 class Calendar(object):
     """
     Draw timeline rows onto an existing PDF object. The page will be
@@ -149,8 +921,13 @@ class Calendar(object):
             label_width=50.0,
             show_year=True,
             one_based=False,
+            metrics=None,
+            first_unit=0,
             ):
         self.pdf = pdf
+        if metrics is None:
+            metrics = TextMetrics(pdf)
+        self.metrics = metrics
 
         self.unit = unit
         if self.unit == 'week':
@@ -167,12 +944,15 @@ class Calendar(object):
             self.dur = n_months
 
         self.first_date = self.normalize(first_date)
+        self.units = unit_table(unit, first_date)
         self.show_year = show_year
         self.nunit = length
         self.label_width = label_width
         self.row_height = 6.0
         self.milestone_radius = 1.1
+        self.min_label_size = 4.0
         self.one_based = one_based
+        self.first_unit = first_unit
         self.t_margin = 3.0
         self.r_margin = 15.0
         self.b_margin = 16.0
@@ -182,6 +962,9 @@ class Calendar(object):
         self.highlight = False
         self.next_row = 0
         self.dep_segments = []
+        self.axis_units = None
+        self.scaled_axis = None
+        self.axis_template = None
 
     def _new_row(self):
         """
@@ -192,15 +975,48 @@ class Calendar(object):
         """
         p = Point(x=self.pdf.get_x(), y=self.pdf.get_y())
         if p.y > self.pdf.h - self.b_margin:
-            self._really_draw_deps()
-            self.dep_segments = []
-            self.next_row = 0
-            self.pdf.add_page()
-            self.draw_time_axis()
+            self.break_page()
             return self._new_row()
         else:
             return p
 
+    def break_page(self):
+        """
+        Dump out all current dependency lines, then start a new page
+        with the time axis at the top.
+        """
+        self._really_draw_deps()
+        self.dep_segments = []
+        self.next_row = 0
+        self.pdf.add_page()
+        self.draw_time_axis()
+
+    def paginate(self,rows):
+        """
+        Work out where the page breaks will fall if rows (anything with
+        a stripe attribute) are drawn from the current position, without
+        drawing anything. Returns a list of Page tuples giving the range
+        of rows on each page and the highlight before its first row.
+        """
+        pages = []
+        y = self.pdf.get_y()
+        top = self.pdf.t_margin + self.t_margin*2.0+6.0
+        highlight = self.highlight
+        first = 0
+        first_highlight = highlight
+        for i, row in enumerate(rows):
+            if y > self.pdf.h - self.b_margin:
+                pages.append(Page(first, i, first_highlight))
+                first = i
+                first_highlight = highlight
+                y = top
+            if row.stripe is not None:
+                highlight = row.stripe
+            highlight = not highlight
+            y = y + self.row_height
+        pages.append(Page(first, len(rows), first_highlight))
+        return pages
+
     def finish(self):
         """
         Draw any remaining things on the timeline chart.
@@ -216,22 +1032,158 @@ class Calendar(object):
                 txt = 'May'
         if width is None:
             width = self.unit_width
-        while 1:
-            self.pdf.set_font('Arial', '', size)
-            if self.pdf.get_string_width(txt) > \
-                    width - 2.0:
-                size -= 0.1
-            else:
-                return size
+        return self.metrics.fit(txt, 'Arial', '', size, width - 2.0)
+
+    def _axis_units(self):
+        """
+        Date label, year label (or None) and index label for each unit
+        on the time axis. These are worked out once per calendar.
+        """
+        if self.axis_units is None:
+            self.axis_units = []
+            for i, unit in enumerate(self.units.starts(self.nunit)):
+                year = None
+                if self.show_year and \
+                        ((unit.month == 1 and unit.day < 7) or i == 0):
+                    year = unit.strftime('%Y')
+                if self.one_based:
+                    number = "%d" % (self.first_unit + i + 1,)
+                else:
+                    number = "%d" % (self.first_unit + i,)
+                self.axis_units.append(
+                        (unit.strftime(self.fmt), year, number))
+        return self.axis_units
+
+    def _scaled_axis(self):
+        """
+        Ticks and labels for a time axis whose units are too narrow to
+        label one by one. Units are grouped by the shortest of months,
+        quarters, years or runs of 2, 5, 10... years whose labels fit,
+        with the years above (unless the groups are years) and the
+        unit numbers below, every 1, 2, 5, 10... units as they fit.
+        Returns a list of (unit, full) ticks, full height at the start
+        of each group or beside the numbers only, and a list of
+        (unit, line, text) labels, line being 0 for years, 1 for
+        groups and 2 for numbers. How much is drawn depends on the
+        width of the axis, not its length. This is worked out once per
+        calendar.
+        """
+        if self.scaled_axis is not None:
+            return self.scaled_axis
+        starts = self.units.starts(self.nunit)
+
+        def marks(key):
+            found, last = [], None
+            for i, unit in enumerate(starts):
+                k = key(unit)
+                if k != last:
+                    found.append(i)
+                    last = k
+            return found
+
+        def fit(found, line, texts, style, size):
+            # label each mark whose text fits before the next one
+            ends = found[1:] + [self.nunit]
+            for i, end, text in zip(found, ends, texts):
+                if (end - i) * self.unit_width >= \
+                        self.metrics.width(text,'Arial',style,size) + 2.0:
+                    labels.append((i, line, text))
+
+        def groups():
+            # (key of a unit's group, its label, whether it's years)
+            if self.unit == 'week':
+                yield (lambda d: (d.year, d.month),
+                        lambda d: d.strftime('%b'), False)
+            yield (lambda d: (d.year, (d.month-1)//3),
+                    lambda d: 'Q%d' % ((d.month+2)//3,), False)
+            for step in nice_steps():
+                yield (lambda d, step=step: d.year // step,
+                        lambda d: '%d' % (d.year,), True)
+
+        # the first group to fit between every pair of whole groups;
+        # with enough years to a group there is at most one whole one
+        for key, text, by_year in groups():
+            found = marks(key)
+            texts = [text(starts[i]) for i in found]
+            need = max([self.metrics.width(t,'Arial','',7.0)
+                for t in set(texts)]) + 2.0
+            if all([(b - a) * self.unit_width >= need
+                    for a, b in zip(found[1:], found[2:])]):
+                break
+
+        labels = []
+        fit(found, 1, texts, '', 7.0)
+        if self.show_year and not by_year:
+            years = marks(lambda d: d.year)
+            fit(years, 0, ['%d' % (starts[i].year,) for i in years],
+                    'B', 5.0)
+
+        offset = self.first_unit + (1 if self.one_based else 0)
+        need = self.metrics.width('%d' % (offset + self.nunit,),
+                'Arial', '', 5.0) + 2.0
+        for step in nice_steps():
+            if step * self.unit_width >= need:
+                break
+        numbers = [i for i in range(-offset % step, self.nunit, step)]
+        fit(numbers, 2, ['%d' % (offset + i,) for i in numbers], '', 5.0)
+
+        full = set(found)
+        ticks = [(i, True) for i in found] + [(self.nunit, True)]
+        ticks += [(i, False) for i in numbers if i not in full]
+        self.scaled_axis = (ticks, labels)
+        return self.scaled_axis
+
+    def _draw_scaled_axis(self,start):
+        """
+        Draw the ticks and labels from _scaled_axis() for a row
+        starting at start.
+        """
+        ticks, labels = self._scaled_axis()
+        x = start.x + self.label_width
+        y = start.y + self.t_margin
+        self.pdf.set_draw_color(200)
+        self.pdf.set_line_width(0.3)
+        for i, full in ticks:
+            self.pdf.line(x + i*self.unit_width, y if full else y + 3.0,
+                    x + i*self.unit_width, y + 6.0)
+        self.pdf.set_text_color(10.0)
+        fonts = [('B', 5.0), ('', 7.0), ('', 5.0)]
+        for i, line, text in sorted(labels, key=lambda label: label[1]):
+            self.pdf.set_font('Arial', *fonts[line])
+            self.pdf.set_xy(x + i*self.unit_width, y + 3.0*(line - 1))
+            self.pdf.write(3.0, text)
 
     def draw_time_axis(self):
         """
-        Draw a time axis along the top of the chart.
+        Draw a time axis along the top of the chart. If the PDF object
+        supports templates, the axis is drawn once into a template
+        which is then stamped onto each page.
         """
         start = self._new_row()
+        if self.axis_template is not None:
+            template, origin = self.axis_template
+            self.pdf.use_template(template,
+                    start.x - origin.x, start.y - origin.y)
+        elif hasattr(self.pdf, 'begin_template'):
+            self.pdf.begin_template()
+            self._draw_time_axis(start)
+            self.axis_template = (self.pdf.end_template(), start)
+            self.pdf.use_template(self.axis_template[0])
+        else:
+            self._draw_time_axis(start)
+        self.pdf.set_xy(start.x, start.y+self.t_margin*2.0+6.0)
+
+    def _draw_time_axis(self,start):
+        """
+        Draw the ticks and labels of the time axis for a row starting
+        at start.
+        """
         size = self._get_label_size()
+        if size < self.min_label_size:
+            self._draw_scaled_axis(start)
+            return
+        units = self._axis_units()
 
-        unit = self.first_date
         for i in range(0,self.nunit+1):
             self.pdf.set_draw_color(200)
             self.pdf.set_line_width(0.3)
@@ -240,31 +1192,24 @@ class Calendar(object):
                     start.x+self.label_width+i*self.unit_width,
                     start.y+self.t_margin+6.0)
             if i < self.nunit:
+                label, year, number = units[i]
                 self.pdf.set_text_color(10.0)
                 self.pdf.set_font('Arial', '', size)
                 self.pdf.set_xy(
                         start.x+self.label_width+i*self.unit_width,
                         start.y+self.t_margin)
-                self.pdf.write(3.0, unit.strftime(self.fmt))
-                if self.show_year and \
-                        ((unit.month == 1 and unit.day < 7) or i == 0):
+                self.pdf.write(3.0, label)
+                if year is not None:
                     self.pdf.set_xy(
                             start.x+self.label_width+i*self.unit_width,
                             start.y+self.t_margin-3.0)
                     self.pdf.set_font('Arial', 'B', 5.0)
-                    self.pdf.write(3.0, unit.strftime('%Y'))
+                    self.pdf.write(3.0, year)
                 self.pdf.set_xy(
                         start.x+self.label_width+i*self.unit_width,
                         start.y+self.t_margin+3.0)
                 self.pdf.set_font('Arial', '', 5.0)
-                if self.one_based:
-                    number = "%d" % (i + 1,)
-                else:
-                    number = "%d" % i
                 self.pdf.write(3.0, number)
-                unit = self.next(unit)
-
-        self.pdf.set_xy(start.x, start.y+self.t_margin*2.0+6.0)
 
     def next_highlight(self,val):
         """
@@ -354,7 +1299,8 @@ class Calendar(object):
                     start.x + self.label_width + at * self.unit_width,
                     start.y
                     )
-            if self.pdf.get_string_width(key) < length * self.unit_width:
+            if self.metrics.width(key, 'Arial', '', 7.0) < \
+                    length * self.unit_width:
                 self.pdf.write(self.row_height,key)
             self.pdf.set_xy(start.x, start.y+self.row_height)
         
@@ -403,6 +1349,7 @@ class Calendar(object):
             self.pdf.write(
                     self.row_height,txt)
             self.pdf.set_draw_color(100)
+            self.pdf.set_line_width(0.3)
 
             if kind == 'breaks':
                 self.pdf.rect(
@@ -458,8 +1405,6 @@ class Calendar(object):
         if up >= self.next_row:
             up = float(self.next_row) - 0.5
         start = Point(x=self.pdf.get_x(), y=self.pdf.get_y()-self.row_height)
-        self.pdf.set_draw_color(100)
-        self.pdf.set_line_width(0.3)
         if to > frm:
             self.dep_segments.append(
                     (
@@ -484,9 +1429,19 @@ class Calendar(object):
         """
         Normalize and draw dependency lines on the current page.
         Normalization removes any duplicated segments so there is no
-        interference between dash phase.
+        interference between dash phase. If the PDF object can, the
+        lines are drawn together as one dashed path.
         """
+        count('dep segments', len(self.dep_segments))
         self.dep_segments = normalize_grid(self.dep_segments)
+        count('dep segments normalized', len(self.dep_segments))
+        if not self.dep_segments:
+            return
+        self.pdf.set_draw_color(100)
+        self.pdf.set_line_width(0.3)
+        if hasattr(self.pdf, 'dashed_lines'):
+            self.pdf.dashed_lines(self.dep_segments,0.6,0.8)
+            return
         for line in self.dep_segments:
             self.pdf.dashed_line(
                     line[0].x,
@@ -497,72 +1452,689 @@ class Calendar(object):
 
 # functions for parsing the project object
 
-def find_item(regex,project):
+class ProjectError(Exception):
     """
-    Find an item by name in the project structure.
+    Error in the content of a project structure.
+    """
+    pass
+
+class CycleError(ProjectError):
+    """
+    Rows whose start times refer to each other in a loop.
+    """
+
+    def __init__(self,names):
+        ProjectError.__init__(self,
+                'circular reference between rows %s' %
+                    ', '.join(["'%s'" % name for name in names]))
+        self.names = names
+
+def reference(spec):
+    """
+    Return the row reference in an 'at' or 'dep' element, or None
+    if it is a concrete time.
     """
-    m = re.match('([+-])(.*)', regex)
-    if m:
-        regex = m.group(2)
-    for item in project['rows']:
-        if re.match(regex + r'\b', item['name'], re.I):
-            return item
+    while type(spec) == list:
+        spec = spec[0]
+    if type(spec) == str:
+        return spec
     return None
 
-def find_at(spec,project):
+def concrete(spec):
     """
-    Parse the 'at' element of a project item, following a reference
-    chain as needed to get a concrete time value.
+    Return the concrete time (unit index or date) in an 'at' element,
+    or None if it is a row reference.
     """
-    type_ = type(spec)
+    while type(spec) == list:
+        spec = spec[0]
+    if type(spec) == str:
+        return None
+    return spec
 
-    if get_option('one_based',project):
-        offset = 1.0
-    else:
-        offset = 0.0
+def freeze(spec):
+    """
+    Hashable copy of an 'at' or 'dep' element.
+    """
+    if type(spec) == list:
+        return tuple([freeze(e) for e in spec])
+    return spec
 
-    if type_ == date:
-        if project['unit'] == 'month':
-            return n_months(first(project['start']),spec)
-        elif project['unit'] == 'week':
-            return n_weeks(monday(project['start']),spec)
+_BOUNDARY = re.compile(r'\b')
+_LITERAL = re.compile(r'[^.^$*+?{}\[\]\\|()]*\Z')
 
-    if type_ == int or type_ == float:
-        return spec - offset
+Key = collections.namedtuple('Key',['name','color'])
+Period = collections.namedtuple('Period',['name','at','length'])
 
-    elif type_ == str:
-        m = re.match(r'([+-])(.*)', spec)
-        if m:
-            end = m.group(1)
-            regex = m.group(2)
+class Row(object):
+    """
+    A resolved row, ready to draw. kind is 'gap', 'breaks', 'phases',
+    'work' or 'milestone'. at and length are in units; color and label
+    are those of a work block's key, if any; deps holds a (start,
+    position, name) tuple for each dependency, with position None for
+    a row in another project; periods holds the Periods of a breaks or
+    phases row.
+    """
+    __slots__ = ('n', 'name', 'kind', 'stripe', 'at', 'length',
+            'color', 'label', 'deps', 'periods')
+
+    def __init__(self,n,name,kind,stripe=None,at=None,length=None,
+            color=None,label=None,deps=(),periods=()):
+        self.n = n
+        self.name = name
+        self.kind = kind
+        self.stripe = stripe
+        self.at = at
+        self.length = length
+        self.color = color
+        self.label = label
+        self.deps = deps
+        self.periods = periods
+
+    def __reduce__(self):
+        return (Row, tuple([getattr(self, name) for name in self.__slots__]))
+
+def overlaps(start,end,lo,hi):
+    """
+    True if the time from start to end overlaps lo to hi, or if it has
+    no length, is anywhere from lo to hi inclusive.
+    """
+    if start == end:
+        return lo <= start <= hi
+    return start < hi and end > lo
+
+class IntervalIndex(object):
+    """
+    Index of (start, end, value) intervals by the whole units they
+    touch, to find those overlapping a range in time proportional to
+    the number found. The few longer than LONG units are kept aside
+    and checked on every lookup.
+    """
+
+    LONG = 64
+
+    def __init__(self,intervals):
+        self.buckets = {}
+        self.long = []
+        for interval in intervals:
+            start, end, value = interval
+            if end - start > self.LONG:
+                self.long.append(interval)
+                continue
+            for unit in range(int(math.floor(start)),
+                    int(math.floor(end)) + 1):
+                self.buckets.setdefault(unit, []).append(interval)
+
+    def overlapping(self,lo,hi):
+        """
+        Set of values of the intervals overlapping lo to hi, including
+        zero-length intervals at either end.
+        """
+        found = set()
+        candidates = list(self.long)
+        for unit in range(int(math.floor(lo)), int(math.floor(hi)) + 1):
+            candidates.extend(self.buckets.get(unit, ()))
+        for start, end, value in candidates:
+            if overlaps(start, end, lo, hi):
+                found.add(value)
+        return found
+
+class Resolver(object):
+    """
+    Resolve time references in a project structure. Rows are found
+    through an index of lower-cased name prefixes ending on a word
+    boundary, and each row's timing is only computed once.
+
+    If a resolver for an earlier version of the same project is given
+    as previous, its name index is reused when no row names have
+    changed, and so is the timing of any row whose definition and
+    upstream timing are unchanged.
+    """
+
+    def __init__(self,project,previous=None):
+        self.project = project
+        if get_option('one_based',project):
+            self.offset = 1.0
+        else:
+            self.offset = 0.0
+        self.names = [item['name'] for item in project['rows']]
+        self.index = None
+        self.found = {}
+        self.timings = None
+        self.signatures = {}
+        self.previous = None
+        self.built = None
+        self.key_list = None
+        self.key_found = {}
+        self.portfolio = None
+        self.index_by_time = None
+
+        if previous is not None and previous.timings is not None and \
+                self._settings() == previous._settings():
+            self.previous = previous
+            if self.names == previous.names:
+                self.index = previous.index
+                self.indexed = previous.indexed
+                self.found = previous.found
+
+    def __getstate__(self):
+        """
+        Pickle without the name index, which is quick to rebuild and
+        unused once every reference has been looked up. Once Rows are
+        built, they are kept instead of the project's row dicts, and
+        the signatures used to resolve a later version are dropped.
+        """
+        state = self.__dict__.copy()
+        state['index'] = None
+        state['previous'] = None
+        state['portfolio'] = None
+        state['index_by_time'] = None
+        if self.built is not None:
+            state['project'] = dict([(k, v)
+                for k, v in self.project.items() if k != 'rows'])
+            state['signatures'] = {}
+        return state
+
+    def _settings(self):
+        """
+        Project-wide values which affect every row's timing.
+        """
+        return (self.project['unit'], self.project['start'], self.offset)
+
+    def _build_index(self):
+        """
+        Map every name prefix which ends on a word boundary to the
+        position of the first row it would match. The index is only
+        usable if all names are plain strings; otherwise lookups fall
+        back to searching the rows one by one.
+        """
+        index = {}
+        for i, name in enumerate(self.names):
+            if type(name) != str:
+                return {}, False
+            lname = name.lower()
+            for m in _BOUNDARY.finditer(name):
+                index.setdefault(lname[:m.start()], i)
+        return index, True
+
+    def _find(self,regex):
+        """
+        Position of the first row matching a reference, or None.
+        """
+        if regex[:1] in ('+', '-'):
+            regex = regex[1:]
+        count('reference lookups')
+        if regex in self.found:
+            count('reference cache hits')
+            return self.found[regex]
+
+        if self.index is None:
+            self.index, self.indexed = self._build_index()
+        if self.indexed and type(regex) == str and _LITERAL.match(regex):
+            pos = self.index.get(regex.lower())
+            count('reference index lookups')
         else:
-            end = '+'
-            regex = spec
+            pos = None
+            for i, name in enumerate(self.names):
+                count('regex matches')
+                if re.match(regex + r'\b', name, re.I):
+                    pos = i
+                    break
+        self.found[regex] = pos
+        return pos
+
+    def _lookup(self,regex):
+        """
+        The Resolver and position of the first row matching a
+        reference, which in a Portfolio may name a row of another
+        project as 'Project:row'. The position is None if nothing
+        matches.
+        """
+        if self.portfolio is None:
+            return self, self._find(regex)
+        if regex[:1] in ('+', '-'):
+            regex = regex[1:]
+        name, colon, rest = regex.partition(':')
+        other = self.portfolio.projects.get(name.strip().lower())
+        if colon and other is not None:
+            return other, other._find(rest.strip())
+        return self, self._find(regex)
+
+    def _shift(self,other):
+        """
+        Units to add to a timing in other's project to place it in
+        this one.
+        """
+        if other.project['unit'] != self.project['unit']:
+            raise ProjectError("project '%s' refers to project '%s', "
+                    "which has a different unit" %
+                    (self.project['project'], other.project['project']))
+        if self.project['unit'] == 'month':
+            return n_months(first(self.project['start']),
+                    first(other.project['start']))
+        return n_weeks(monday(self.project['start']),
+                monday(other.project['start']))
+
+    def find_item(self,regex):
+        """
+        Find an item by name in the project structure.
+        """
+        pos = self._find(regex)
+        if pos is None:
+            return None
+        return self.project['rows'][pos]
 
-        parent = find_item(regex,project)
-        parent_at, parent_length = get_timing(parent,project)
+    def find_at(self,spec):
+        """
+        Parse the 'at' element of a project item, following a reference
+        chain as needed to get a concrete time value.
+        """
+        type_ = type(spec)
 
-        if end == '+':
-            at = parent_at + parent_length
-        elif end == '-':
-            at = parent_at
-        return at
+        if type_ == date:
+            return unit_table(self.project['unit'],
+                    self.project['start']).position(spec)
 
-    elif type_ == list:
-        parent_at = find_at(spec[0],project)
-        at = parent_at + spec[1]
-        return at
+        if type_ == int or type_ == float:
+            return spec - self.offset
+
+        elif type_ == str:
+            if spec[:1] in ('+', '-'):
+                end = spec[0]
+                regex = spec[1:]
+            else:
+                end = '+'
+                regex = spec
+
+            owner, pos = self._lookup(regex)
+            if pos is None:
+                raise ProjectError("reference '%s' matches no row" % spec)
+            parent_at, parent_length = owner._timing(pos)
+            if owner is not self:
+                parent_at += self._shift(owner)
+
+            if end == '+':
+                at = parent_at + parent_length
+            elif end == '-':
+                at = parent_at
+            return at
+
+        elif type_ == list:
+            parent_at = self.find_at(spec[0])
+            at = parent_at + spec[1]
+            return at
+
+    def _timing(self,pos):
+        """
+        Timing of the row at a given position.
+        """
+        if self.timings is None:
+            self.resolve()
+        timing = self.timings[pos]
+        if timing is None:
+            raise ProjectError("row '%s' has no start time" %
+                    self.names[pos])
+        return timing
+
+    def keys(self):
+        """
+        The project's keys, as Keys.
+        """
+        if self.key_list is None:
+            self.key_list = [Key(key['name'], key['color'])
+                    for key in self.project.get('keys', [])]
+        return self.key_list
+
+    def find_key(self,name):
+        """
+        The first Key whose name matches name, as get_key(), or None.
+        """
+        if name not in self.key_found:
+            self.key_found[name] = None
+            for key in self.keys():
+                if re.match(name + r'\b', key.name, re.I):
+                    self.key_found[name] = key
+                    break
+        return self.key_found[name]
+
+    def build_row(self,n,item,timing):
+        """
+        Build the Row for item, the nth row, given its timing.
+        """
+        name = item['name']
+        if item.get('gap'):
+            return Row(n, name, 'gap', item.get('stripe'))
+
+        for kind in ('breaks', 'phases'):
+            if kind in item:
+                periods = tuple([Period(b['name'], self.find_at(b['at']),
+                    b['length']) for b in item[kind]])
+                return Row(n, name, kind, item.get('stripe'),
+                        periods=periods)
+
+        if timing is None:
+            raise ProjectError("row '%s' has no start time" % name)
+        at, length = timing
+        color = label = None
+        if 'length' in item:
+            kind = 'work'
+            if 'key' in item:
+                key = self.find_key(item['key'])
+                if key is None:
+                    raise ProjectError("key '%s' in row '%s' matches "
+                            "no key" % (item['key'], name))
+                color = key.color
+                if get_option('key_in_block',self.project):
+                    label = key.name
+        else:
+            kind = 'milestone'
+
+        deps = ()
+        if 'dep' in item:
+            if type(item['dep']) != list:
+                specs = [item['dep']]
+            else:
+                specs = item['dep']
+            deps = []
+            for spec in specs:
+                owner, pos = self._lookup(reference(spec))
+                dep_name = owner.names[pos]
+                if owner is not self:
+                    pos = None
+                deps.append((self.find_at(spec), pos, dep_name))
+            deps = tuple(deps)
+
+        return Row(n, name, kind, item.get('stripe'), at, length,
+                color, label, deps)
+
+    def rows(self):
+        """
+        The project's rows as Rows, built once after resolving.
+        """
+        if self.built is None:
+            timings = self.resolve()
+            self.built = [self.build_row(n, item, timings[n])
+                    for n, item in enumerate(self.project['rows'])]
+        return self.built
+
+    def intervals(self):
+        """
+        An IntervalIndex of the position of each Row by the time it
+        covers (its work block or milestone, or each of its breaks or
+        phases), and a list of the positions of gap rows. Both are
+        built once.
+        """
+        if self.index_by_time is None:
+            intervals = []
+            gaps = []
+            for row in self.rows():
+                if row.periods:
+                    intervals.extend([(p.at, p.at + p.length, row.n)
+                        for p in row.periods])
+                elif row.at is not None:
+                    intervals.append((row.at, row.at + row.length, row.n))
+                elif row.kind == 'gap':
+                    gaps.append(row.n)
+            self.index_by_time = (IntervalIndex(intervals), gaps)
+        return self.index_by_time
+
+    def get_timing(self,item):
+        """
+        Find the duration of an item, returning 0 for milestones.
+        """
+        for pos, row in enumerate(self.project['rows']):
+            if row is item:
+                return self._timing(pos)
+        raise ProjectError("row '%s' is not in the project" % item['name'])
+
+    def _graph(self):
+        """
+        Build the reference graph: for each row, the Resolver and
+        position of the row its start time refers to (or None),
+        checking that every reference in the project matches a row with
+        a start time. Every date in the project is converted to units
+        on the way, in one batch.
+        """
+        rows = self.project['rows']
+        parents = []
+        dates = []
+        for item in rows:
+            refs = []
+            if 'dep' in item:
+                if type(item['dep']) != list:
+                    refs = [item['dep']]
+                else:
+                    refs = list(item['dep'])
+            for b in item.get('breaks', []) + item.get('phases', []):
+                if reference(b['at']) is not None:
+                    refs.append(b['at'])
+                elif type(concrete(b['at'])) == date:
+                    dates.append(concrete(b['at']))
+            for spec in refs:
+                if reference(spec) is None:
+                    raise ProjectError("dependency '%s' in row '%s' "
+                            "is not a row reference" % (spec, item['name']))
+            refs = [reference(spec) for spec in refs]
+            ref = None
+            if 'at' in item:
+                ref = reference(item['at'])
+                refs.append(ref)
+                if ref is None and type(concrete(item['at'])) == date:
+                    dates.append(concrete(item['at']))
+            for spec in refs:
+                if spec is None:
+                    continue
+                owner, pos = self._lookup(spec)
+                if pos is None:
+                    raise ProjectError("reference '%s' in row '%s' "
+                            "matches no row" % (spec, item['name']))
+                if owner is self and 'at' not in rows[pos]:
+                    raise ProjectError("row '%s' referred to by '%s' "
+                            "has no start time" %
+                            (rows[pos]['name'], item['name']))
+            if ref is None:
+                parents.append(None)
+            else:
+                parents.append(self._lookup(ref))
+
+        unit_table(self.project['unit'], self.project['start']).convert(dates)
+        return parents
+
+    def resolve(self):
+        """
+        Resolve the timing of every row in topological order of the
+        reference graph, returning a list with one (at, length) tuple
+        per row, or None for rows without 'at'. Raises CycleError if
+        references form a loop.
+        """
+        if self.timings is None:
+            _resolve([self])
+        return self.timings
+
+class StreamResolver(Resolver):
+    """
+    Resolve time references for rows which are read one at a time,
+    keeping only the name, index entries and timing of each row seen
+    so far. References must be to earlier rows.
+    """
+
+    def __init__(self,project):
+        Resolver.__init__(self,dict(project, rows=[]))
+        self.index = {}
+        self.indexed = True
+        self.timings = []
+
+    def add(self,item):
+        """
+        Resolve the timing of the next row from the rows before it and
+        remember it for later rows, returning (at, length) or None.
+        """
+        refs = []
+        if 'dep' in item:
+            if type(item['dep']) != list:
+                refs = [item['dep']]
+            else:
+                refs = list(item['dep'])
+            for spec in refs:
+                if reference(spec) is None:
+                    raise ProjectError("dependency '%s' in row '%s' "
+                            "is not a row reference" % (spec, item['name']))
+        for b in item.get('breaks', []) + item.get('phases', []):
+            refs.append(b['at'])
+        if 'at' in item:
+            refs.append(item['at'])
+        # a miss is remembered, but always ends the drawing here
+        for spec in refs:
+            ref = reference(spec)
+            if ref is not None and self._find(ref) is None:
+                raise ProjectError("reference '%s' in row '%s' "
+                        "matches no earlier row" % (ref, item['name']))
+
+        if 'at' in item:
+            if 'length' in item:
+                length = item['length']
+            else:
+                length = 0
+            timing = (self.find_at(item['at']), length)
+        else:
+            timing = None
+
+        name = item['name']
+        if type(name) != str:
+            self.indexed = False
+        elif self.indexed:
+            lname = name.lower()
+            for m in _BOUNDARY.finditer(name):
+                self.index.setdefault(lname[:m.start()], len(self.names))
+        self.names.append(name)
+        self.timings.append(timing)
+        return timing
+
+class Portfolio(object):
+    """
+    Resolvers for several projects to be drawn into one document. If
+    cross is set, a reference in one project may name a row of another
+    as 'Project:row' (or '-Project:row', ['Project:row',2] and so on),
+    where Project is the other's project name, and every project is
+    resolved together in one pass. Both must use the same unit.
+    """
+
+    def __init__(self,resolvers,cross=False):
+        self.resolvers = resolvers
+        self.projects = {}
+        if cross:
+            for resolver in resolvers:
+                name = str(resolver.project['project']).lower()
+                self.projects.setdefault(name, resolver)
+                resolver.portfolio = self
+
+    def rows(self):
+        """
+        The Rows of every project, as a list of lists.
+        """
+        unresolved = [r for r in self.resolvers if r.timings is None]
+        if unresolved:
+            _resolve(unresolved)
+        return [resolver.rows() for resolver in self.resolvers]
+
+def _resolve(resolvers):
+    """
+    Resolve the timing of every row of some Resolvers together, in
+    topological order of the references within and between them,
+    filling in each one's timings. Raises CycleError if references
+    form a loop.
+    """
+    number = dict([(id(r), k) for k, r in enumerate(resolvers)])
+    parents = []
+    children = []
+    for r in resolvers:
+        graph = []
+        for parent in r._graph():
+            if parent is not None:
+                parent = (number.get(id(parent[0])), parent[1])
+            graph.append(parent)
+        parents.append(graph)
+        children.append([[] for item in r.project['rows']])
+        r.timings = [None] * len(r.project['rows'])
+
+    # rows are resolved in order, so find_at() only ever needs timings
+    # which are already filled in; a reference to a project resolved
+    # before (eg loaded from a cache) counts as a concrete time
+    queue = []
+    for k, r in enumerate(resolvers):
+        for i, item in enumerate(r.project['rows']):
+            parent = parents[k][i]
+            if parent is not None and parent[0] is not None:
+                children[parent[0]][parent[1]].append((k, i))
+            elif 'at' in item:
+                queue.append((k, i))
+    while queue:
+        k, i = queue.pop()
+        r = resolvers[k]
+        item = r.project['rows'][i]
+        if 'length' in item:
+            length = item['length']
+        else:
+            length = 0
+        parent = parents[k][i]
+        if parent is None or parent[0] is None:
+            upstream = None
+        else:
+            upstream = resolvers[parent[0]].timings[parent[1]]
+        signature = (item['name'], freeze(item['at']), length)
+        if r.previous is not None:
+            old = r.previous.signatures.get(signature)
+        else:
+            old = None
+        if old is not None and old[0] == upstream:
+            r.timings[i] = old[1]
+        else:
+            r.timings[i] = (r.find_at(item['at']), length)
+        r.signatures[signature] = (upstream, r.timings[i])
+        queue.extend(children[k][i])
+
+    for k, r in enumerate(resolvers):
+        for i, item in enumerate(r.project['rows']):
+            if 'at' in item and r.timings[i] is None:
+                # every unresolved row leads to a loop: walk up to it
+                seen = {}
+                path = []
+                node = (k, i)
+                while node not in seen:
+                    seen[node] = len(path)
+                    path.append(node)
+                    node = parents[node[0]][node[1]]
+                names = []
+                for j, n in path[seen[node]:]:
+                    name = resolvers[j].project['rows'][n]['name']
+                    if len(resolvers) > 1:
+                        name = '%s:%s' % (resolvers[j].project['project'],
+                                name)
+                    names.append(name)
+                for r in resolvers:
+                    r.timings = None
+                raise CycleError(names)
+
+    for r in resolvers:
+        r.previous = None
+
+def find_item(regex,project):
+    """
+    Find an item by name in the project structure.
+    """
+    return Resolver(project).find_item(regex)
+
+def find_at(spec,project):
+    """
+    Parse the 'at' element of a project item, following a reference
+    chain as needed to get a concrete time value.
+    """
+    return Resolver(project).find_at(spec)
 
 def get_timing(item,project):
     """
     Find the duration of an item, returning 0 for milestones.
     """
-    at = find_at(item['at'],project)
-    if 'length' in item:
-        length = item['length']
-    else:
-        length = 0
-    return (at, length)
+    return Resolver(project).get_timing(item)
 
 def get_key(key,project):
     """
@@ -584,36 +2156,576 @@ def get_option(name,project,default=None):
         return default
     return project['options'][name]
 
-# main function to read filename (.yml) and draw corresponding .pdf
+# reading project files
+
+def parse(text):
+    """
+    Parse YAML text into a project structure, using libyaml if the
+    yaml module was built with it.
+    """
+    import yaml
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    return yaml.load(text, Loader=loader)
+
+def _compose(loader,event,anchors):
+    """
+    Build the YAML node starting with event from the events which
+    follow it, as the composer would for a whole document.
+    """
+    import yaml
+    if isinstance(event, yaml.AliasEvent):
+        if event.anchor not in anchors:
+            raise ProjectError("undefined alias '%s'" % event.anchor)
+        return anchors[event.anchor]
+
+    tag = event.tag
+    if isinstance(event, yaml.ScalarEvent):
+        if tag is None or tag == '!':
+            tag = loader.resolve(yaml.ScalarNode, event.value, event.implicit)
+        node = yaml.ScalarNode(tag, event.value,
+                event.start_mark, event.end_mark, event.style)
+    elif isinstance(event, yaml.SequenceStartEvent):
+        if tag is None or tag == '!':
+            tag = loader.resolve(yaml.SequenceNode, None, event.implicit)
+        node = yaml.SequenceNode(tag, [], event.start_mark, None,
+                event.flow_style)
+    else:
+        if tag is None or tag == '!':
+            tag = loader.resolve(yaml.MappingNode, None, event.implicit)
+        node = yaml.MappingNode(tag, [], event.start_mark, None,
+                event.flow_style)
+    if event.anchor is not None:
+        anchors[event.anchor] = node
+
+    if isinstance(event, yaml.SequenceStartEvent):
+        while not loader.check_event(yaml.SequenceEndEvent):
+            node.value.append(_compose(loader, loader.get_event(), anchors))
+        node.end_mark = loader.get_event().end_mark
+    elif isinstance(event, yaml.MappingStartEvent):
+        while not loader.check_event(yaml.MappingEndEvent):
+            key = _compose(loader, loader.get_event(), anchors)
+            value = _compose(loader, loader.get_event(), anchors)
+            node.value.append((key, value))
+        node.end_mark = loader.get_event().end_mark
+    return node
+
+def read_yaml_rows(fh):
+    """
+    Read a YAML project from fh incrementally. Returns the project
+    without its rows, and an iterator which parses the rows one at a
+    time; rows must be the last key of the project.
+    """
+    import yaml
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)(fh)
+    anchors = {}
+    next_value = lambda: loader.construct_document(
+            _compose(loader, loader.get_event(), anchors))
+
+    loader.get_event()
+    loader.get_event()
+    if not loader.check_event(yaml.MappingStartEvent):
+        raise ProjectError('project is not a mapping')
+    loader.get_event()
+    project = {}
+    has_rows = False
+    while not loader.check_event(yaml.MappingEndEvent):
+        key = next_value()
+        if key == 'rows':
+            has_rows = True
+            break
+        project[key] = next_value()
+
+    def rows():
+        if not has_rows:
+            return
+        if not loader.check_event(yaml.SequenceStartEvent):
+            raise ProjectError("'rows' is not a list")
+        loader.get_event()
+        while not loader.check_event(yaml.SequenceEndEvent):
+            yield next_value()
+        loader.get_event()
+        if not loader.check_event(yaml.MappingEndEvent):
+            raise ProjectError("'rows' must be the last key of a project "
+                    "which is read incrementally")
+    return project, rows()
+
+_ISO_DATE = re.compile(r'(\d{4})-(\d{2})-(\d{2})\Z')
+
+def _from_json(value):
+    """
+    Convert a value decoded from JSON to what YAML would have given:
+    byte strings, and dates for strings like 2015-11-30.
+    """
+    if isinstance(value, dict):
+        return dict([(_from_json(k), _from_json(v))
+            for k, v in value.items()])
+    if isinstance(value, list):
+        return [_from_json(v) for v in value]
+    if isinstance(value, unicode):
+        m = _ISO_DATE.match(value)
+        if m:
+            return date(*[int(g) for g in m.groups()])
+        return value.encode('utf-8')
+    return value
+
+def read_json_rows(fh):
+    """
+    Read a project in JSON Lines form from fh: the first line is an
+    object with the project metadata, options and keys, and each
+    following line is one row. Returns the project without its rows,
+    and an iterator over the rows.
+    """
+    import json
+    project = _from_json(json.loads(fh.readline()))
+    if not isinstance(project, dict):
+        raise ProjectError('first line is not a JSON object')
+    first = project.pop('rows', [])
+
+    def rows():
+        for row in first:
+            yield row
+        for line in fh:
+            if line.strip():
+                yield _from_json(json.loads(line))
+    return project, rows()
+
+CACHE_VERSION = 4
+
+def load(filename,cache_dir=None,fast_validate=False,resolve=True):
+    """
+    Read, parse, validate and resolve a project file, returning its
+    Resolver. If cache_dir is given, the resolver is pickled there
+    under a hash of the file content, and later loads of the same
+    content skip all of that work. With resolve false, a Resolver
+    which hasn't resolved anything yet is returned (unless cached),
+    eg to put in a Portfolio first, and nothing is stored.
+    """
+    with stage('read'):
+        with file(filename,'rb') as fh:
+            text = fh.read()
+
+    cached = None
+    if cache_dir is not None:
+        digest = hashlib.sha1('%d\n%s' % (CACHE_VERSION, text)).hexdigest()
+        cached = os.path.join(cache_dir, digest + '.pickle')
+        try:
+            with stage('cache load'):
+                with file(cached,'rb') as fh:
+                    return cPickle.load(fh)
+        except Exception:
+            # missing, truncated or written by something else: redraw
+            pass
+
+    with stage('parse'):
+        project = parse(text)
+    with stage('validate'):
+        validate(project,fast_validate)
+    resolver = Resolver(project)
+    if not resolve:
+        return resolver
+    with stage('resolve'):
+        resolver.rows()
+
+    if cached is not None:
+        with stage('cache store'):
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            import tempfile
+            fd, tmp = tempfile.mkstemp(dir=cache_dir)
+            with os.fdopen(fd,'wb') as fh:
+                cPickle.dump(resolver, fh, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, cached)
+    return resolver
+
+# schema validation
+
+_pykwalify = {}
+
+def have_pykwalify():
+    """
+    True if pykwalify is installed. It is imported, and its logging
+    quietened, the first time this is called.
+    """
+    if 'installed' not in _pykwalify:
+        import logging
+        logging.basicConfig()
+        logging.getLogger('pykwalify.core').setLevel('CRITICAL')
+        try:
+            import pykwalify.core
+            import pykwalify.errors
+            _pykwalify['installed'] = True
+        except ImportError:
+            _pykwalify['installed'] = False
+    return _pykwalify['installed']
+
+_schema = {}
 
-def draw(filename):
+def load_schema():
+    """
+    Return the parsed schema.yml from the script's directory. It is
+    only read once.
+    """
+    if 'data' not in _schema:
+        srcdir = os.path.dirname(os.path.abspath(__file__))
+        with file(os.path.join(srcdir,"schema.yml"),'r') as fh:
+            _schema['data'] = parse(fh.read())
+    return _schema['data']
+
+_TYPES = {
+    'str':    lambda v: isinstance(v, basestring),
+    'int':    lambda v: isinstance(v, (int, long)) and
+                            not isinstance(v, bool),
+    'float':  lambda v: isinstance(v, float),
+    'number': lambda v: isinstance(v, (int, long, float)) and
+                            not isinstance(v, bool),
+    'bool':   lambda v: isinstance(v, bool),
+    'date':   lambda v: isinstance(v, date),
+    'map':    lambda v: isinstance(v, dict),
+    'seq':    lambda v: isinstance(v, list),
+    'any':    lambda v: True,
+    }
+
+def compile_rule(rule):
+    """
+    Turn a kwalify-style schema rule into a function which checks a
+    value against it, appending any problems to a list of messages.
+    Covers the rules used in schema.yml: type, req, enum, range,
+    mapping and sequence.
+    """
+    type_ = rule.get('type', 'str')
+    is_type = _TYPES[type_]
+    enum = rule.get('enum')
+    range_ = rule.get('range', {})
+    mapping = None
+    if 'mapping' in rule:
+        mapping = dict([(key, compile_rule(sub))
+            for key, sub in rule['mapping'].items()])
+        required = sorted([key for key, sub in rule['mapping'].items()
+            if sub.get('req')])
+    sequence = None
+    if 'sequence' in rule:
+        sequence = compile_rule(rule['sequence'][0])
+
+    def check(value,path,errors):
+        if value is None:
+            return
+        if not is_type(value):
+            errors.append("Value '%s' is not of type '%s'. Path: '%s'." %
+                    (value, type_, path or '/'))
+            return
+        if enum is not None and value not in enum:
+            errors.append("Enum '%s' does not exist. Path: '%s'." %
+                    (value, path or '/'))
+        if 'min' in range_ and value < range_['min']:
+            errors.append("Value '%s' is less than min limit '%s'. "
+                    "Path: '%s'." % (value, range_['min'], path or '/'))
+        if 'max' in range_ and value > range_['max']:
+            errors.append("Value '%s' is greater than max limit '%s'. "
+                    "Path: '%s'." % (value, range_['max'], path or '/'))
+        if mapping is not None:
+            for key in required:
+                if value.get(key) is None:
+                    errors.append("Cannot find required key '%s'. "
+                            "Path: '%s'." % (key, path or '/'))
+            for key, sub in sorted(value.items()):
+                if key not in mapping:
+                    errors.append("Key '%s' was not defined. Path: '%s'." %
+                            (key, path or '/'))
+                else:
+                    mapping[key](sub, '%s/%s' % (path, key), errors)
+        if sequence is not None:
+            for i, sub in enumerate(value):
+                sequence(sub, '%s/%d' % (path, i), errors)
 
-    if HAVE_PYKWALIFY:
-        srcdir = \
-            os.path.dirname(
-                    os.path.abspath(
-                        inspect.getfile(inspect.currentframe())))
+    return check
 
-        validator = pykwalify.core.Core(source_file=filename,
-                schema_files=[
-                    os.path.join(srcdir,"schema.yml")])
+def validate(project,fast=False):
+    """
+    Check a parsed project structure against schema.yml, raising
+    ProjectError if it doesn't conform. Uses pykwalify if installed,
+    or the built-in checker if fast is set.
+    """
+    if fast:
+        if 'check' not in _schema:
+            _schema['check'] = compile_rule(load_schema())
+        errors = []
+        _schema['check'](project, '', errors)
+        if errors:
+            raise ProjectError('input schema validation error\n'
+                    'Schema validation failed:\n - ' + '\n - '.join(errors))
+    elif have_pykwalify():
+        import pykwalify.core
+        import pykwalify.errors
+        validator = pykwalify.core.Core(source_data=project,
+                schema_data=load_schema())
         try:
             validator.validate(raise_exception=True)
         except pykwalify.errors.SchemaError, e:
-            print "Error: input schema validation error"
-            print e.msg
-            sys.exit(1)
-        
-    with file(filename,'r') as fh:
-        project = yaml.load(fh.read())
+            raise ProjectError('input schema validation error\n' + e.msg)
+
+def validate_rows(project,rows):
+    """
+    Check a project without its rows against schema.yml with the
+    built-in checker, and return an iterator which checks each of rows
+    as it is read. Raises ProjectError for the project or the first
+    row which doesn't conform.
+    """
+    if 'check_header' not in _schema:
+        schema = load_schema()
+        mapping = dict(schema['mapping'])
+        row = mapping.pop('rows')['sequence'][0]
+        _schema['check_header'] = compile_rule(dict(schema, mapping=mapping))
+        _schema['check_row'] = compile_rule(row)
+
+    def check(rule,value,path):
+        errors = []
+        _schema[rule](value, path, errors)
+        if errors:
+            raise ProjectError('input schema validation error\n'
+                    'Schema validation failed:\n - ' + '\n - '.join(errors))
+
+    def checked():
+        for n, item in enumerate(rows):
+            check('check_row', item, '/rows/%d' % n)
+            yield item
+
+    check('check_header', project, '')
+    return checked()
+
+# rendering a project structure to PDF
+
+class Window(object):
+    """
+    Part of a project to draw: length units from the one containing
+    the date start, and only rows whose names match the regex match
+    (a string or compiled pattern), with the headings (gap rows) of the
+    sections they are in. Any of these may be None for no limit.
+    """
+
+    def __init__(self,start=None,length=None,match=None):
+        self.start = start
+        self.length = length
+        self.match = match
+
+    def _units(self,project):
+        """
+        The first unit in the window and the number of units.
+        """
+        lo = 0
+        if self.start is not None:
+            table = unit_table(project['unit'], project['start'])
+            lo = int(math.floor(table.position(self.start)))
+        if self.length is None:
+            length = project['length'] - lo
+        elif self.length <= 0:
+            raise ProjectError('window length must be positive')
+        else:
+            length = self.length
+        if length <= 0:
+            raise ProjectError('window starts after the end of the timeline')
+        return lo, length
+
+    def project(self,project):
+        """
+        Copy of a project structure with the start and length of the
+        window, and the number of its first unit.
+        """
+        lo, length = self._units(project)
+        start = unit_table(project['unit'], project['start']).start(lo)
+        return dict(project, start=start, length=length), lo
 
-    n = 0
-    for item in project['rows']:
-        item['n'] = n
-        n += 1
+    def rows(self,resolver):
+        """
+        The Rows of a resolved project which are in the window,
+        renumbered, with times relative to its first unit and cut off at
+        its ends. The rows in a time window are found through the
+        project's IntervalIndex, so only they are looked at.
+        """
+        rows = resolver.rows()
+        timed = self.start is not None or self.length is not None
+        if not timed and self.match is None:
+            return rows
+        lo, units = self._units(resolver.project)
+        hi = lo + units
+
+        index, gaps = resolver.intervals()
+        if timed:
+            shown = index.overlapping(lo, hi)
+        else:
+            shown = range(len(rows))
+        if self.match is not None:
+            regex = self.match
+            if isinstance(regex, basestring):
+                regex = re.compile(regex, re.I)
+            shown = [n for n in shown if regex.search(str(rows[n].name))]
+        shown = set(shown)
+        for n in list(shown):
+            heading = bisect.bisect_right(gaps, n) - 1
+            if heading >= 0:
+                shown.add(gaps[heading])
+        shown = sorted(shown)
+        count('rows in window', len(shown))
+
+        number = dict([(n, i) for i, n in enumerate(shown)])
+        window = []
+        for i, n in enumerate(shown):
+            row = rows[n]
+            at, length, periods = row.at, row.length, row.periods
+            deps = [(start, number.get(pos), name)
+                    for start, pos, name in row.deps]
+            if timed:
+                if at is not None:
+                    at, length = self._cut(at, length, lo, hi)
+                periods = [Period(p.name, *self._cut(p.at, p.length, lo, hi))
+                        for p in periods
+                        if overlaps(p.at, p.at + p.length, lo, hi)]
+                deps = [(min(max(start - lo, 0), units), pos, name)
+                        for start, pos, name in deps]
+            window.append(Row(i, row.name, row.kind, row.stripe, at,
+                length, row.color, row.label, tuple(deps), tuple(periods)))
+        return window
+
+    def _cut(self,at,length,lo,hi):
+        """
+        Start and length of a block cut off at lo and hi, with the start
+        relative to lo.
+        """
+        start = max(at, lo)
+        return start - lo, min(at + length, hi) - start
+
+def render(project,stream=None,resolver=None,jobs=1,window=None):
+    """
+    Render a project structure, or YAML text describing one, to PDF.
+    The PDF is written to stream if one is given, a page at a time as
+    they are drawn, otherwise returned as a string. No schema
+    validation is done; see draw(). A Resolver for the project may be
+    passed in to reuse its work. See layout() for jobs and window.
+    """
+    if isinstance(project, basestring):
+        with stage('parse'):
+            project = parse(project)
+
+    if resolver is None:
+        resolver = Resolver(project)
+    if resolver.built is None:
+        with stage('resolve'):
+            resolver.rows()
+    with stage('draw'):
+        pdf = layout(project,resolver,jobs,window,stream)
+    return _output(pdf,stream)
+
+def _output(pdf,stream):
+    """
+    Finish a Document drawn by layout() or layout_portfolio(),
+    returning the PDF as a string if it wasn't drawn to a stream.
+    """
+    with stage('output'):
+        if stream is None:
+            data = pdf.output(dest='S')
+        else:
+            pdf.close()
+    count('pages', pdf.page)
+    count('pdf bytes', len(pdf.buffer))
+    if stream is None:
+        return data
+
+def layout(project,resolver,jobs=1,window=None,stream=None):
+    """
+    Draw a project structure onto a new Document, returning it. If
+    jobs isn't 1, the pages are drawn in parallel by that many worker
+    processes (None for one per CPU); see _layout_pages(). If a Window
+    is given, only that part of the project is drawn. If a stream is
+    given, pages are written to it as they are finished; see Document.
+    """
+    project, rows, first_unit = _window_rows(project,resolver,window)
+    pdf, cal = _begin_layout(project,first_unit=first_unit,stream=stream)
+    if jobs == 1:
+        for row in rows:
+            _layout_row(cal,row)
+    else:
+        _layout_pages(project,pdf,cal,rows,jobs)
+    _end_layout(pdf,cal,project,resolver.keys())
+    count('rows', len(rows))
+    return pdf
+
+def render_svg(project,stream=None,resolver=None,window=None):
+    """
+    Render a project structure, or YAML text describing one, to SVG,
+    as render() does to PDF. The SVG is written to stream as it is
+    drawn, rather than built up in memory, or returned as a string if
+    there's no stream.
+    """
+    if isinstance(project, basestring):
+        with stage('parse'):
+            project = parse(project)
+
+    if resolver is None:
+        resolver = Resolver(project)
+    if resolver.built is None:
+        with stage('resolve'):
+            resolver.rows()
+    output = stream
+    if stream is None:
+        from cStringIO import StringIO
+        output = StringIO()
+    with stage('draw'):
+        svg = layout_svg(project,resolver,output,window)
+    count('svg bytes', svg.bytes)
+
+    if stream is None:
+        return output.getvalue()
+
+def layout_svg(project,resolver,stream,window=None):
+    """
+    Draw a project structure as SVG onto stream, as layout() does onto
+    a Document, returning the finished SVGDocument. The chart is one
+    page, as tall as it needs to be.
+    """
+    project, rows, first_unit = _window_rows(project,resolver,window)
+    keys = resolver.keys()
+
+    # title, time axis, rows, legend and footer as _begin_layout() and
+    # _end_layout() place them, so the Calendar never breaks the page
+    height = 10.0 + 12.0 + 6.0 * len(rows) + 20.0
+    if get_option('title',project,True):
+        height += 10.0
+    if 'keys' in project and get_option('key_legend',project):
+        height += 20.0 + 6.0 * len(keys)
+
+    svg = SVGDocument(stream,h=height)
+    pdf, cal = _begin_layout(project,svg,first_unit=first_unit)
+    for row in rows:
+        _layout_row(cal,row)
+    _end_layout(pdf,cal,project,keys)
+    svg.close()
+    count('rows', len(rows))
+    return svg
+
+def _window_rows(project,resolver,window):
+    """
+    The project metadata, rows and first unit number to draw: all of
+    them, or only those in a Window.
+    """
+    if window is None:
+        return project, resolver.rows(), 0
+    project, first_unit = window.project(project)
+    return project, window.rows(resolver), first_unit
 
-    pdf = FPDF('L','mm','A4')
-    pdf.set_auto_page_break(False)
+def _begin_layout(project,pdf=None,metrics=None,axes=None,first_unit=0,
+        stream=None):
+    """
+    Start a new Document, written to stream if one is given (or a new
+    page of pdf), with the title and time axis for a project,
+    returning it and the Calendar to draw rows with. Only the project
+    metadata, options and keys are needed, not the rows. Calendars
+    drawing onto the same Document can share TextMetrics, and a dict
+    axes to share time axes between projects with the same unit,
+    start, length and label width. The units on the axis are numbered
+    from first_unit.
+    """
+    if pdf is None:
+        pdf = Document('L','mm','A4',stream=stream)
+        pdf.set_auto_page_break(False)
     pdf.add_page()
     pdf.set_font('Arial', 'B', 16)
     title = get_option('title',project,'%s timeline' % project['project'])
@@ -627,71 +2739,180 @@ def draw(filename):
             show_year=get_option('show_year',project),
             label_width=get_option('label_width',project,50.0),
             one_based=get_option('one_based',project),
+            metrics=metrics,
+            first_unit=first_unit,
             )
+    if axes is None:
+        cal.draw_time_axis()
+        return pdf, cal
+
+    axis = (cal.unit, cal.first_date, cal.nunit, cal.label_width,
+            cal.unit_width, cal.show_year, cal.one_based, cal.first_unit)
+    if axis in axes:
+        cal.axis_units, cal.scaled_axis, cal.axis_template = axes[axis]
+        count('time axes shared')
     cal.draw_time_axis()
+    axes[axis] = (cal.axis_units, cal.scaled_axis, cal.axis_template)
+    return pdf, cal
 
-    n = -1
-    for item in project['rows']:
-        n += 1
-
-        if 'stripe' in item:
-            cal.next_highlight(item['stripe'])
-
-        if 'gap' in item and item['gap']:
-            cal.draw_gap(item['name'])
-            continue
-
-        if 'breaks' in item:
-            breaks = []
-            for b in item['breaks']:
-                tup = (b['name'], find_at(b['at'],project), b['length'])
-                breaks.append(tup)
-            cal.draw_breaks(item['name'], *breaks)
-            continue
-
-        if 'phases' in item:
-            phases = []
-            for b in item['phases']:
-                tup = (b['name'], find_at(b['at'],project), b['length'])
-                phases.append(tup)
-            cal.draw_phases(item['name'], *phases)
-            continue
+def _layout_row(cal,row):
+    """
+    Draw a Row.
+    """
+    if row.stripe is not None:
+        cal.next_highlight(row.stripe)
 
-        at, length = get_timing(item,project)
+    kind = row.kind
+    if kind == 'gap':
+        cal.draw_gap(row.name)
+        return
+    if kind == 'breaks':
+        cal.draw_breaks(row.name, *row.periods)
+        return
+    if kind == 'phases':
+        cal.draw_phases(row.name, *row.periods)
+        return
 
-        if 'length' in item:
-            if 'key' in item:
-                key = get_key(item['key'], project)
-                color = key['color']
-                key_name = key['name']
-            else:
-                color = None
-                key_name = None
-            if not get_option('key_in_block',project):
-                key_name = None
-            cal.draw_work(item['name'], at, length, color, key_name)
+    if kind == 'work':
+        cal.draw_work(row.name, row.at, row.length, row.color, row.label)
+    else:
+        cal.draw_milestone(row.name, row.at)
+
+    for dep_start, dep_pos, dep_name in row.deps:
+        if dep_start > row.at:
+            print "Warning: '%s' before its dependency '%s'" % (
+                row.name, dep_name)
+        if dep_pos is None:
+            # from another project: drawn down from the top of the page
+            cal.draw_dep(dep_start, row.at, row.n + 1)
         else:
-            cal.draw_milestone(item['name'], at)
+            cal.draw_dep(dep_start, row.at, row.n - dep_pos)
 
-        if 'dep' in item:
-            if type(item['dep']) != list:
-                deps = [item['dep']]
-            else:
-                deps = item['dep']
-            for dep in deps:
-                dep_start = find_at(dep,project)
-                dep_item  = find_item(dep,project)
-                dep_up = n - dep_item['n']
-                if dep_start > at:
-                    print "Warning: '%s' before its dependency '%s'" % (
-                        item['name'], dep_item['name'])
-                cal.draw_dep(dep_start, at, dep_up)
-   
+def render_portfolio(portfolio,stream=None):
+    """
+    Render every project of a Portfolio into one PDF, as render() does
+    for one project.
+    """
+    if any(r.built is None for r in portfolio.resolvers):
+        with stage('resolve'):
+            portfolio.rows()
+    with stage('draw'):
+        pdf = layout_portfolio(portfolio,stream)
+    return _output(pdf,stream)
+
+def layout_portfolio(portfolio,stream=None):
+    """
+    Draw every project of a Portfolio onto a new Document, each
+    starting on a new page, returning it. The projects share fonts,
+    text measurements, and the time axis when they have the same one.
+    See layout() for stream.
+    """
+    pdf = metrics = None
+    axes = {}
+    for resolver in portfolio.resolvers:
+        pdf, cal = _begin_layout(resolver.project,pdf,metrics,axes,
+                stream=stream)
+        metrics = cal.metrics
+        rows = resolver.rows()
+        for row in rows:
+            _layout_row(cal,row)
+        _end_layout(pdf,cal,resolver.project,resolver.keys())
+        count('rows', len(rows))
+    count('projects', len(portfolio.resolvers))
+    return pdf
+
+def _layout_pages(project,pdf,cal,rows,jobs=None):
+    """
+    Draw rows in two phases: first work out which rows fall on each
+    page, then draw runs of pages in worker processes, and put their
+    content into pdf. This leaves pdf and cal as if the rows had been
+    drawn directly, ready for _end_layout().
+    """
+    import multiprocessing
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    elif jobs < 1:
+        raise ValueError('jobs must be at least 1, not %r' % (jobs,))
+    pdf.preload_fonts('Arial', ('B', '', 'I'))
+    with stage('paginate'):
+        pages = cal.paginate(rows)
+
+    # a few runs per worker, so that they all finish at about the same
+    # time even if some pages are slower to draw than others
+    size = max(1, -(-len(pages) // (jobs * 4)))
+    header = dict([(k, v) for k, v in project.items() if k != 'rows'])
+    work = []
+    for i in range(0, len(pages), size):
+        run = pages[i:i+size]
+        work.append((header, cal.first_unit, rows[run[0].first:run[-1].end],
+            i, run[0].highlight, len(run)))
+    count('page runs', len(work))
+
+    if jobs == 1 or len(work) < 2:
+        results = map(_draw_pages, work)
+    else:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            results = pool.map(_draw_pages, work, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    pdf._flush_path()
+    pdf.pages = {}
+    for contents, state, highlight, next_row, messages in results:
+        sys.stdout.write(messages)
+        for content in contents:
+            pdf.pages[len(pdf.pages)+1] = content
+    pdf.page = len(pdf.pages)
+    for name, value in state.items():
+        setattr(pdf, name, value)
+    cal.highlight = highlight
+    cal.next_row = next_row
+    cal.dep_segments = []
+
+def _draw_pages(args):
+    """
+    Draw a run of pages for _layout_pages(), in a worker process.
+    Returns the content of each page, the drawing state of the
+    Document and Calendar after the last, and any warnings printed,
+    so they can be shown in order.
+    """
+    from cStringIO import StringIO
+    project, first_unit, rows, page, highlight, npages = args
+    stdout = sys.stdout
+    sys.stdout = messages = StringIO()
+    try:
+        pdf, cal = _begin_layout(project,first_unit=first_unit)
+        pdf.preload_fonts('Arial', ('B', '', 'I'))
+        if page > 0:
+            cal.break_page()
+        cal.highlight = highlight
+        for row in rows:
+            _layout_row(cal,row)
+        cal.finish()
+        pdf._flush_path()
+    finally:
+        sys.stdout = stdout
+
+    first = pdf.page - npages + 1
+    assert first == (1 if page == 0 else 2), 'pages drawn and paginated differ'
+    contents = [pdf.pages[n] for n in range(first, pdf.page+1)]
+    state = dict([(name, getattr(pdf, name))
+        for name in pdf._STATE + ('font_op', 'x', 'y')])
+    return (contents, state, cal.highlight, cal.next_row,
+            messages.getvalue())
+
+def _end_layout(pdf,cal,project,keys):
+    """
+    Finish the last page of rows, and add the legend of keys and the
+    footer.
+    """
     cal.finish()
 
     if 'keys' in project and get_option('key_legend',project):
         if pdf.h - pdf.get_y()  < (10.0 + 10.0 + 
-                cal.row_height * len(project['keys']) + cal.b_margin):
+                cal.row_height * len(keys) + cal.b_margin):
             pdf.add_page()
         pdf.set_y(pdf.get_y() + 10.0)
         pdf.set_text_color(0)
@@ -699,8 +2920,8 @@ def draw(filename):
         pdf.cell(80,10,'Key',ln=2)
         cal.highlight = False
 
-        for key in project['keys']:
-            cal.draw_key(key['name'], key['color'])
+        for key in keys:
+            cal.draw_key(key.name, key.color)
 
     footer = get_option('footer', project,
         '%s timeline / version %s / built %s' %
@@ -713,12 +2934,557 @@ def draw(filename):
         pdf.set_y(pdf.h-15.0)
         pdf.write(10,footer)
 
-    pdf.output(re.sub(r'\.yml$','.pdf',sys.argv[1]))
+# main function to read filename (.yml) and draw corresponding .pdf
+
+@contextlib.contextmanager
+def _replacing(output):
+    """
+    Open a file to write in place of output, which is only replaced
+    once the with block succeeds, so a failed draw leaves any previous
+    output as it was.
+    """
+    import tempfile
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(output) or '.')
+    try:
+        with os.fdopen(fd,'wb') as fh:
+            yield fh
+        # mkstemp makes the file private; give it the usual mode
+        mask = os.umask(0)
+        os.umask(mask)
+        os.chmod(tmp, 0666 & ~mask)
+        os.rename(tmp, output)
+    except:
+        os.remove(tmp)
+        raise
+
+def draw(filename,output=None,fast_validate=False,cache_dir=None,
+        stream=False,jobs=1,window=None,svg=False):
+    """
+    Read and validate a project from filename, and draw it to output,
+    by default the same name with a .pdf extension (or .svg if svg is
+    true, to draw SVG instead). See load() for cache_dir, draw_stream()
+    for stream, which is implied for JSON Lines (.jsonl) files, and
+    layout() for jobs and window.
+    """
+    if stream or filename.endswith('.jsonl'):
+        return draw_stream(filename,output)
+
+    resolver = load(filename,cache_dir,fast_validate)
+    if window is not None:
+        # check the window fits before creating the output
+        window.project(resolver.project)
+
+    if output is None:
+        output = re.sub(r'\.yml$','.svg' if svg else '.pdf',filename)
+    with _replacing(output) as fh:
+        if svg:
+            render_svg(resolver.project,fh,resolver,window)
+        else:
+            render(resolver.project,fh,resolver,jobs,window)
+
+# drawing very large files a row at a time
+
+def draw_stream(filename,output=None):
+    """
+    Draw a project from filename without holding all of its rows in
+    memory: rows are read, validated with the built-in checker,
+    resolved and drawn one at a time, and only the names and timings
+    needed by later references are kept. filename is YAML, whose rows
+    must be its last key, or JSON Lines if it ends in .jsonl.
+    References must be to earlier rows. The PDF is written a page at a
+    time, as rows are drawn, and only replaces output once it is
+    complete.
+    """
+    if output is None:
+        output = re.sub(r'\.(yml|jsonl)$','.pdf',filename)
+    with file(filename,'rb') as fh, _replacing(output) as out:
+        with stage('stream'):
+            if filename.endswith('.jsonl'):
+                project, rows = read_json_rows(fh)
+            else:
+                project, rows = read_yaml_rows(fh)
+            rows = validate_rows(project,rows)
+            resolver = StreamResolver(project)
+            pdf, cal = _begin_layout(project,stream=out)
+            n = -1
+            for n, item in enumerate(rows):
+                timing = resolver.add(item)
+                _layout_row(cal,resolver.build_row(n,item,timing))
+            _end_layout(pdf,cal,project,resolver.keys())
+            count('rows', n + 1)
+        _output(pdf,out)
+
+# watching a file and redrawing it when it changes
+
+def watch(filename,output=None,fast_validate=False,interval=0.1):
+    """
+    Draw filename, then poll it and draw it again whenever its content
+    changes, until interrupted. The schema, fonts and the previous
+    resolver are kept, so only changed rows are re-resolved. Errors
+    are reported and watching continues.
+    """
+    from yaml import YAMLError
+    if output is None:
+        output = re.sub(r'\.yml$','.pdf',filename)
+    stamp = None
+    digest = None
+    resolver = None
+    while True:
+        try:
+            st = os.stat(filename)
+        except OSError:
+            st = None
+        if st is not None and (st.st_mtime, st.st_size) != stamp:
+            stamp = (st.st_mtime, st.st_size)
+            with file(filename,'r') as fh:
+                text = fh.read()
+            if hashlib.sha1(text).digest() != digest:
+                digest = hashlib.sha1(text).digest()
+                start = time.time()
+                try:
+                    project = parse(text)
+                    validate(project,fast_validate)
+                    resolver = Resolver(project,resolver)
+                    data = render(project,resolver=resolver)
+                    with _replacing(output) as fh:
+                        fh.write(data)
+                    print "%s: drew %s in %.3fs" % (
+                            time.strftime('%H:%M:%S'), output,
+                            time.time() - start)
+                except (ProjectError, YAMLError), e:
+                    resolver = None
+                    print "%s: Error: %s" % (time.strftime('%H:%M:%S'), e)
+                except Exception, e:
+                    # eg a half-saved file which isn't a project yet
+                    resolver = None
+                    print "%s: %s: %s" % (time.strftime('%H:%M:%S'),
+                            type(e).__name__, e)
+                sys.stdout.flush()
+        time.sleep(interval)
+
+# batch rendering of many files
+
+def _expand(patterns):
+    """
+    Filenames matching a list of names or glob patterns, in order and
+    without repeats.
+    """
+    filenames = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            matches = [pattern]
+        filenames.extend([f for f in matches if f not in filenames])
+    return filenames
+
+def _draw_one(args):
+    """
+    Draw one file for draw_batch(), returning (filename, error, time)
+    where error is None on success.
+    """
+    filename, fast_validate, cache_dir = args
+    start = time.time()
+    error = None
+    try:
+        draw(filename, fast_validate=fast_validate, cache_dir=cache_dir)
+    except ProjectError, e:
+        error = str(e)
+    except Exception, e:
+        error = '%s: %s' % (type(e).__name__, e)
+    return (filename, error, time.time() - start)
+
+def draw_batch(patterns,jobs=None,fast_validate=False,cache_dir=None):
+    """
+    Draw every file matching a list of names or glob patterns, in
+    parallel across jobs worker processes (default one per CPU).
+    Returns a list of (filename, error, time) in input order.
+    """
+    work = [(filename, fast_validate, cache_dir)
+            for filename in _expand(patterns)]
+    if jobs == 1 or len(work) < 2:
+        return map(_draw_one, work)
+    import multiprocessing
+    pool = multiprocessing.Pool(jobs)
+    try:
+        return pool.map(_draw_one, work, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+# drawing many projects into one portfolio PDF
+
+def draw_portfolio(patterns,output,fast_validate=False,cache_dir=None,
+        cross=False):
+    """
+    Read and validate every file matching a list of names or glob
+    patterns, and draw them in order into one PDF, output. See
+    Portfolio for cross.
+    """
+    resolvers = []
+    for filename in _expand(patterns):
+        try:
+            resolvers.append(load(filename,cache_dir,fast_validate,
+                not cross))
+        except ProjectError, e:
+            raise ProjectError('%s: %s' % (filename, e))
+    portfolio = Portfolio(resolvers,cross)
+    with _replacing(output) as fh:
+        render_portfolio(portfolio,fh)
+
+# serving rendered PDFs over HTTP
+
+class LRUCache(object):
+    """
+    The size most recently used values, by key. Safe to share between
+    threads.
+    """
+    def __init__(self,size):
+        import threading
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self,key):
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                self.entries[key] = value
+            return value
+
+    def put(self,key,value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+_WARMUP = """
+project: Warmup
+version: 1
+unit: week
+length: 4
+start: 2016-01-04
+keys: [{name: Key, color: [0,0,0]}]
+rows: [{name: A, at: 0, length: 1, key: key}, {name: B, at: A, dep: A}]
+"""
+
+def _warm_worker(fast_validate):
+    """
+    Load the schema and fonts in a new server worker by drawing a
+    small project, so the first real request doesn't pay for them.
+    """
+    project = parse(_WARMUP)
+    validate(project,fast_validate)
+    render(project)
+
+def _serve_one(args):
+    """
+    Draw one request for serve(), returning (status, body) where body
+    is the PDF (or SVG if svg is true) for status 200, or an error
+    message.
+    """
+    text, kind, svg, fast_validate = args
+    import StringIO
+    from yaml import YAMLError
+    try:
+        if kind == 'jsonl':
+            project, rows = read_json_rows(StringIO.StringIO(text))
+            project['rows'] = list(rows)
+        elif kind == 'json':
+            import json
+            project = _from_json(json.loads(text))
+        else:
+            project = parse(text)
+        if not isinstance(project, dict):
+            raise ProjectError('project is not a mapping')
+        validate(project,fast_validate)
+        if svg:
+            return (200, render_svg(project))
+        return (200, render(project))
+    except (ProjectError, YAMLError, ValueError), e:
+        return (400, 'Error: %s\n' % e)
+    except Exception, e:
+        return (500, '%s: %s\n' % (type(e).__name__, e))
+
+def serve(port=8000,host='localhost',jobs=None,queue=16,cache_size=64,
+        fast_validate=False,timeout=60.0):
+    """
+    Serve PDFs over HTTP until interrupted. POST a project as YAML, or
+    as JSON or JSON Lines (by Content-Type), and the PDF comes back,
+    or SVG if the request accepts image/svg+xml.
+    Requests are drawn by a pool of jobs worker processes (default one
+    per CPU) which are warmed up first; at most queue requests wait
+    for a worker beyond those being drawn, and others are turned away
+    with 503, as are requests that would wait while timed out ones are
+    still being drawn. The last cache_size PDFs are kept by a hash of
+    their request and the date, so repeated requests cost nothing.
+    """
+    import BaseHTTPServer
+    import SocketServer
+    import multiprocessing
+    import threading
+
+    workers = jobs or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(workers, _warm_worker, (fast_validate,))
+    slots = threading.BoundedSemaphore(workers + queue)
+    cache = LRUCache(cache_size)
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        server_version = 'uProject'
+
+        def reply(self,status,body,headers=(),ctype='application/pdf'):
+            self.send_response(status)
+            for name, value in headers:
+                self.send_header(name, value)
+            if status != 304:
+                if status == 200:
+                    self.send_header('Content-Type', ctype)
+                else:
+                    self.send_header('Content-Type', 'text/plain')
+                self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if status != 304:
+                self.wfile.write(body)
+
+        def do_POST(self):
+            try:
+                length = int(self.headers.get('Content-Length'))
+            except (TypeError, ValueError):
+                return self.reply(411, 'Content-Length required\n')
+            text = self.rfile.read(length)
+            ctype = self.headers.get('Content-Type', '').split(';')[0]
+            if ctype in ('application/x-ndjson', 'application/jsonl'):
+                kind = 'jsonl'
+            elif ctype == 'application/json':
+                kind = 'json'
+            else:
+                kind = 'yaml'
+            svg = 'image/svg+xml' in self.headers.get('Accept', '')
+            ctype = 'image/svg+xml' if svg else 'application/pdf'
+            # the footer shows today's date, so the same project
+            # draws differently tomorrow
+            etag = '"%s"' % hashlib.sha1(ctype + '\n' + kind + '\n' +
+                    date.today().isoformat() + '\n' + text).hexdigest()
+
+            body = cache.get(etag)
+            if body is not None:
+                if self.headers.get('If-None-Match') == etag:
+                    return self.reply(304, '', [('ETag', etag)])
+                return self.reply(200, body,
+                        [('ETag', etag), ('X-Cache', 'hit')], ctype)
+
+            if not slots.acquire(False):
+                return self.reply(503, 'Busy, try again\n',
+                        [('Retry-After', '1')])
+            # the slot is freed when the worker finishes, not when we
+            # stop waiting for it, so timed out requests still count
+            try:
+                result = pool.apply_async(_serve_one,
+                        ((text, kind, svg, fast_validate),),
+                        callback=lambda result: slots.release())
+            except:
+                slots.release()
+                raise
+            try:
+                status, body = result.get(timeout)
+            except multiprocessing.TimeoutError:
+                status, body = 504, 'Timed out drawing project\n'
+
+            if status != 200:
+                return self.reply(status, body)
+            cache.put(etag, body)
+            self.reply(200, body, [('ETag', etag), ('X-Cache', 'miss')],
+                    ctype)
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    server = Server((host, port), Handler)
+    print "Serving on http://%s:%d/ with %d workers" % (host, port, workers)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        pool.terminate()
+        pool.join()
 
 # toplevel
 
-if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print "Usage: uproject.py [input.yml]"
+def _window_arg(text):
+    """
+    Parse --window: a start date (or 'today') and/or a number of
+    units, as DATE, DATE:UNITS or :UNITS.
+    """
+    import argparse
+    start, colon, units = text.partition(':')
+    try:
+        if start == 'today':
+            start = date.today()
+        elif start:
+            start = date(*[int(part) for part in start.split('-')])
+        else:
+            start = None
+        units = int(units) if units else None
+    except (ValueError, TypeError):
+        raise argparse.ArgumentTypeError(
+                "expected DATE, DATE:UNITS or :UNITS, not '%s'" % text)
+    return start, units
+
+def _match_arg(text):
+    """
+    Compile --match, so a bad pattern is an error before anything is
+    drawn.
+    """
+    import argparse
+    try:
+        return re.compile(text, re.I)
+    except re.error, e:
+        raise argparse.ArgumentTypeError(
+                "invalid regular expression '%s': %s" % (text, e))
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog='uproject.py',
+            description='Draw a Gantt chart PDF from a YAML description.')
+    parser.add_argument('input', nargs='*',
+            help='project description (.yml)')
+    parser.add_argument('--fast-validate', action='store_true',
+            help='validate with the built-in checker, not pykwalify')
+    parser.add_argument('--batch', action='store_true',
+            help='draw many files or glob patterns in parallel')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+            help='worker processes for --batch, --parallel or --serve '
+                '(default: one per CPU)')
+    parser.add_argument('--parallel', action='store_true',
+            help='draw the pages of a long chart in parallel')
+    parser.add_argument('--portfolio', metavar='PDF', default=None,
+            help='draw many files or glob patterns into one PDF')
+    parser.add_argument('--cross', action='store_true',
+            help="let --portfolio projects refer to each other's rows")
+    parser.add_argument('--window', metavar='DATE:UNITS', type=_window_arg,
+            default=None,
+            help='only draw UNITS weeks or months from DATE (or today)')
+    parser.add_argument('--match', metavar='REGEX', type=_match_arg,
+            default=None,
+            help='only draw rows whose names match REGEX')
+    parser.add_argument('--svg', action='store_true',
+            help='draw SVG instead of PDF')
+    parser.add_argument('--watch', action='store_true',
+            help='keep running, redrawing the input whenever it changes')
+    parser.add_argument('--cache', metavar='DIR', default=None,
+            help='keep parsed and resolved projects in DIR')
+    parser.add_argument('--stream', action='store_true',
+            help='read and draw rows one at a time, for very large input')
+    parser.add_argument('--serve', metavar='PORT', type=int, default=None,
+            help='serve PDFs of projects POSTed to localhost:PORT')
+    parser.add_argument('--queue', type=int, default=16,
+            help='requests --serve lets wait for a worker (default 16)')
+    parser.add_argument('--lru', metavar='N', type=int, default=64,
+            help='PDFs --serve keeps for repeated requests (default 64)')
+    parser.add_argument('--profile', action='store_const', const='table',
+            help='report time spent in each stage of drawing')
+    parser.add_argument('--profile-json', action='store_const',
+            const='json', dest='profile',
+            help='report the same as JSON')
+    args = parser.parse_args(argv)
+
+    if args.jobs is not None and args.jobs < 1:
+        parser.error('-j needs at least one worker')
+    if args.profile and (args.batch or args.watch or args.serve):
+        parser.error('--profile only works when drawing a single file')
+    if (args.window or args.match) and (args.batch or args.stream or
+            args.watch or args.portfolio is not None or
+            args.serve is not None):
+        parser.error('--window and --match only work when drawing a '
+                'single file')
+    if args.svg and (args.batch or args.stream or args.watch or
+            args.parallel or args.portfolio is not None or
+            args.serve is not None):
+        parser.error('--svg only works when drawing a single file')
+    if args.cross and args.portfolio is None:
+        parser.error('--cross only works with --portfolio')
+    if args.portfolio is not None and (args.batch or args.watch or
+            args.stream or args.parallel or args.serve is not None):
+        parser.error('--portfolio does not work with --batch, --watch, '
+                '--stream, --parallel or --serve')
+
+    if args.serve is not None:
+        if args.input:
+            parser.error('--serve takes no input files')
+        try:
+            serve(args.serve, jobs=args.jobs, queue=args.queue,
+                    cache_size=args.lru, fast_validate=args.fast_validate)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    if not args.input:
+        parser.error('no input given')
+
+    if args.batch:
+        start = time.time()
+        results = draw_batch(args.input, args.jobs, args.fast_validate,
+                args.cache)
+        failed = 0
+        for filename, error, elapsed in results:
+            if error is None:
+                print "ok    %6.2fs  %s" % (elapsed, filename)
+            else:
+                failed += 1
+                print "FAIL  %6.2fs  %s: %s" % (elapsed, filename,
+                        error.replace('\n', '\n      '))
+        print "%d drawn, %d failed in %.2fs" % (
+                len(results) - failed, failed, time.time() - start)
+        if failed:
+            sys.exit(1)
+        return
+
+    if args.portfolio is not None:
+        job = lambda: draw_portfolio(args.input, args.portfolio,
+                args.fast_validate, args.cache, args.cross)
+    else:
+        if len(args.input) > 1:
+            parser.error('only one input allowed; use --batch for more')
+
+        if args.parallel and (args.stream or args.watch):
+            parser.error('--parallel does not work with --stream or --watch')
+
+        if args.watch:
+            try:
+                watch(args.input[0], fast_validate=args.fast_validate)
+            except KeyboardInterrupt:
+                pass
+            return
+
+        jobs = args.jobs if args.parallel else 1
+        window = None
+        if args.window or args.match:
+            start, units = args.window or (None, None)
+            window = Window(start, units, args.match)
+        job = lambda: draw(args.input[0], fast_validate=args.fast_validate,
+                cache_dir=args.cache, stream=args.stream, jobs=jobs,
+                window=window, svg=args.svg)
+
+    profile = Profile()
+    try:
+        if args.profile:
+            with profile:
+                job()
+        else:
+            job()
+    except ProjectError, e:
+        print "Error: %s" % e
         sys.exit(1)
-    draw(sys.argv[1])
+
+    if args.profile == 'json':
+        print profile.json()
+    elif args.profile:
+        print profile.table()
+
+if __name__ == "__main__":
+    # run as the uproject module, so what is pickled (the resolve
+    # cache, work for worker processes) names its classes as library
+    # callers see them, not as __main__
+    import imp
+    imp.load_source('uproject', __file__).main(sys.argv[1:])